@@ -0,0 +1,77 @@
+"""
+Benchmarks parsing Bar-Coded Boarding Pass strings.
+
+Generates boarding pass strings by varying the mandatory fields of a
+sample pass, times BoardingPass.parse_many on them, and prints the
+number of passes parsed per second. Some strings are truncated, so the
+invalid data path is timed as well.
+
+Run from the repository root, with the package installed (see Editable
+Installation in the README):
+    python benchmarks/bcbp_parse.py [--count COUNT] [--repeat REPEAT]
+"""
+
+import argparse
+import random
+import string
+import time
+
+from flight_log_tools.boarding_pass import BoardingPass
+
+SAMPLE_BCBP = (
+    "M1DOE/JOHN            EABC123 BOSJFKB6 0717 345P014C0010 147>3180 "
+    "M6344BB6              29279          0 B6 B6 1234567890          "
+    "^108abcdefgh"
+)
+AIRPORTS = ["ATL", "BOS", "DFW", "JFK", "LAX", "ORD", "SEA", "SFO"]
+
+def generate_bcbp_strs(count, seed=0):
+    """Generates boarding pass strings from the sample pass."""
+    rng = random.Random(seed)
+    bcbp_strs = []
+    for _ in range(count):
+        name = "".join(rng.choices(string.ascii_uppercase, k=8))
+        pnr = "".join(rng.choices(string.ascii_uppercase + string.digits, k=6))
+        orig, dest = rng.sample(AIRPORTS, 2)
+        bcbp_str = (
+            f"M1{name + '/' + name[:3]:<20}E{pnr:<7}{orig}{dest}B6 "
+            f"{rng.randrange(1, 10000):04d} {rng.randrange(1, 367):03d}"
+            f"Y{rng.randrange(1, 40):03d}{rng.choice('ABCDEF')}"
+            + SAMPLE_BCBP[52:]
+        )
+        if rng.random() < 0.1:
+            bcbp_str = bcbp_str[:rng.randrange(len(bcbp_str))]
+        bcbp_strs.append(bcbp_str)
+    return bcbp_strs
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark parsing boarding pass strings."
+    )
+    parser.add_argument("--count",
+        help="Number of boarding pass strings to parse (default 5000)",
+        default=5000,
+        type=int,
+    )
+    parser.add_argument("--repeat",
+        help="Number of timed runs; the fastest is reported (default 5)",
+        default=5,
+        type=int,
+    )
+    args = parser.parse_args()
+
+    bcbp_strs = generate_bcbp_strs(args.count)
+    times = []
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        boarding_passes = BoardingPass.parse_many(bcbp_strs)
+        times.append(time.perf_counter() - start)
+    valid_count = sum(bp.valid for bp in boarding_passes)
+    print(
+        f"Parsed {args.count} boarding passes ({valid_count} valid) in "
+        f"{min(times) * 1000:.1f} ms: "
+        f"{args.count / min(times):,.0f} passes per second."
+    )
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+"""
+Checks that fast CLI paths do not import heavy libraries.
+
+Runs `python -X importtime -m flight_log_tools` for --help and for a
+command sent to a server with --client (answered by a stub server on a
+temporary socket), and fails if any of HEAVY_MODULES were imported.
+Prints the wall time of each run, and the slowest imports.
+
+Run from the repository root:
+    python benchmarks/import_time.py
+"""
+
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+# Libraries which are slow to import, and are only needed once a command
+# runs locally.
+HEAVY_MODULES = [
+    "geopandas", "numpy", "pandas", "pyarrow", "pyogrio", "pyproj",
+    "requests", "shapely",
+]
+REPO_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def main():
+    failures = []
+    failures += check_imports("--help", ["--help"])
+    with tempfile.TemporaryDirectory() as temp_dir:
+        socket_path = os.path.join(temp_dir, "flight_log_tools.sock")
+        with stub_server(socket_path):
+            failures += check_imports(
+                "--client", ["--client", "--socket", socket_path, "stats"],
+            )
+    if len(failures) > 0:
+        print("FAILED: " + "; ".join(failures))
+        sys.exit(1)
+    print("OK: no heavy modules were imported.")
+
+def check_imports(name, cli_args):
+    """
+    Runs the CLI with import timing, and checks the modules it imported.
+
+    Returns a list of failure messages.
+    """
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-m", "flight_log_tools",
+            *cli_args],
+        cwd=REPO_PATH,
+        capture_output=True,
+        text=True,
+    )
+    wall_time = time.perf_counter() - start
+    imports = parse_importtime(result.stderr)
+    print(f"{name}: {wall_time * 1000:.0f} ms wall, {len(imports)} modules")
+    for module, cumulative_us in sorted(
+        imports.items(), key=lambda item: item[1], reverse=True,
+    )[:5]:
+        print(f"    {cumulative_us / 1000:8.1f} ms  {module}")
+
+    failures = []
+    if result.returncode != 0:
+        failures.append(f"{name} exited with status {result.returncode}")
+    heavy = sorted(
+        {module.split(".")[0] for module in imports} & set(HEAVY_MODULES)
+    )
+    if len(heavy) > 0:
+        failures.append(f"{name} imported {', '.join(heavy)}")
+    return failures
+
+def parse_importtime(stderr):
+    """
+    Parses -X importtime output.
+
+    Returns a dict of cumulative import time in microseconds, keyed by
+    module name.
+    """
+    imports = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        fields = line.removeprefix("import time:").split("|")
+        if len(fields) != 3 or not fields[1].strip().isdigit():
+            continue # Header line
+        imports[fields[2].strip()] = int(fields[1])
+    return imports
+
+class stub_server:
+    """
+    Context manager running a stub flight log server on a socket.
+
+    The server accepts one command, and replies with exit status 0.
+    """
+    def __init__(self, socket_path):
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(socket_path)
+        self.server.listen()
+        self.thread = threading.Thread(target=self.handle, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.close()
+
+    def handle(self):
+        connection, _ = self.server.accept()
+        with connection, connection.makefile("rwb") as stream:
+            stream.readline()
+            stream.write(json.dumps({'exit': 0}).encode("utf-8") + b"\n")
+            stream.flush()
+
+if __name__ == "__main__":
+    main()
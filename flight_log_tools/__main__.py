@@ -1,12 +1,23 @@
 """Tools for interacting with a local GeoPackage flight log."""
 
 import argparse
-import flight_log_tools.tools as flt
+import os
+import sys
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         description="Tools for interacting with a local flight log."
     )
+    parser.add_argument("--client",
+        action="store_true",
+        help="Send the command to a running flight log server",
+    )
+    parser.add_argument("--socket",
+        help="Path of the flight log server socket",
+        metavar="SOCKET_PATH",
+        default=os.getenv("FLIGHT_LOG_SOCKET_PATH"),
+        type=str,
+    )
     subparsers = parser.add_subparsers(dest="command", required=True)
 
     # add
@@ -50,6 +61,118 @@ if __name__ == "__main__":
         action="store_true",
         help="Add recent flights from Flight Historian"
     )
+    add_flight_parser.add_argument("--retry-failed",
+        action="store_true",
+        help="With --pkpasses, retry files which failed to import before",
+    )
+
+    # compress-fa-json
+    parser_compress_fa_json = subparsers.add_parser(
+        "compress-fa-json",
+        help="Move AeroAPI fa_json payloads into compressed storage",
+    )
+    parser_compress_fa_json.add_argument("--decompress",
+        action="store_true",
+        help="Move compressed payloads back into the flights layer",
+    )
+
+    # ensure-indexes
+    parser_ensure_indexes = subparsers.add_parser(
+        "ensure-indexes",
+        help="Create any missing lookup indexes",
+    )
+
+    # export
+    parser_export = subparsers.add_parser(
+        "export",
+        help="Export a layer to GeoParquet, FlatGeobuf, or GeoJSONSeq",
+    )
+    parser_export.add_argument("layer",
+        choices=["airports", "flights", "routes"],
+        help="Layer to export",
+    )
+    parser_export.add_argument("path",
+        help=(
+            "Output file path (.parquet, .fgb, or .geojsonl, unless a "
+            "format is given)"
+        ),
+        type=str,
+    )
+    parser_export.add_argument("--format",
+        choices=["fgb", "geojsonseq", "parquet"],
+        help="Output file format",
+    )
+    parser_export.add_argument("--changed",
+        action="store_true",
+        help=(
+            "Export records added, edited, or deleted since the last "
+            "--changed export to the same path to a separate changes file"
+        ),
+    )
+    parser_export.add_argument("--changes-path",
+        help=(
+            "Changes file path for --changed exports (default: the path "
+            "with .changes before its extension)"
+        ),
+        type=str,
+    )
+
+    # query
+    parser_query = subparsers.add_parser(
+        "query",
+        help="Find features which pass through a region",
+    )
+    parser_query.add_argument("layer",
+        choices=["airports", "flights", "routes"],
+        help="Layer to query",
+    )
+    query_region_group = parser_query.add_mutually_exclusive_group(
+        required=True,
+    )
+    query_region_group.add_argument("--bbox",
+        help=(
+            "Bounding box in degrees (MIN_LON greater than MAX_LON crosses "
+            "the antimeridian)"
+        ),
+        metavar=("MIN_LON", "MIN_LAT", "MAX_LON", "MAX_LAT"),
+        nargs=4,
+        type=float,
+    )
+    query_region_group.add_argument("--wkt",
+        help="Region geometry as WKT, in longitude and latitude",
+        type=str,
+    )
+    parser_query.add_argument("--predicate",
+        choices=["crosses", "intersects", "within"],
+        default="intersects",
+        help="Spatial relationship features must have with the region",
+    )
+
+    # simplify-tracks
+    parser_simplify_tracks = subparsers.add_parser(
+        "simplify-tracks",
+        help="Generate simplified flight tracks for any flights missing them",
+    )
+    parser_simplify_tracks.add_argument("--rebuild",
+        action="store_true",
+        help="Regenerate simplified tracks for all flights",
+    )
+
+    # stats
+    parser_stats = subparsers.add_parser(
+        "stats",
+        help="Show flight log statistics",
+    )
+    parser_stats.add_argument("--top",
+        default=10,
+        help="Number of airports, routes, airlines, etc. to show",
+        metavar="COUNT",
+        type=int,
+    )
+    parser_stats.add_argument("--rebuild",
+        action="store_true",
+        help="Rebuild statistics from all flights before showing them",
+    )
 
     # update-routes
     parser_update_routes = subparsers.add_parser(
@@ -57,19 +180,30 @@ if __name__ == "__main__":
         help="Manually refresh routes layer",
     )
 
+    # serve
+    parser_serve = subparsers.add_parser(
+        "serve",
+        help="Run commands sent by clients over a local socket",
+    )
+
     # Parse arguments
     args = parser.parse_args()
-    if args.command == "add":
-        if args.entity == "flight":
-            if args.bcbp is not None:
-                flt.parse_bcbp(args.bcbp)
-            elif args.fa_flight_id is not None:
-                flt.add_fa_flight_id(args.fa_flight_id)
-            elif args.flight_number is not None:
-                flt.add_flight_number(*args.flight_number)
-            elif args.pkpasses:
-                flt.import_boarding_passes()
-            elif args.recent:
-                flt.import_recent()
-    elif args.command == "update-routes":
-        flt.update_routes()
+    if args.command == "export":
+        # Resolve paths here, since a server may run in another folder.
+        args.path = os.path.abspath(args.path)
+        if args.changes_path is not None:
+            args.changes_path = os.path.abspath(args.changes_path)
+
+    if args.command == "serve":
+        from flight_log_tools.server import serve
+        serve(args.socket)
+    elif args.client and getattr(args, 'flight_number', None) is None:
+        # Selecting a flight by number needs input, so it always runs
+        # locally.
+        from flight_log_tools.server import send_command
+        sys.exit(send_command(args, args.socket))
+    else:
+        # Import commands only once arguments are valid, so that help
+        # and usage errors don't wait on the libraries the commands use.
+        import flight_log_tools.tools as flt
+        flt.run_command(args)
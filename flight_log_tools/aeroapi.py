@@ -2,63 +2,166 @@
 
 import json
 import os
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
 from dateutil.parser import isoparse
 
 import colorama
-import requests
 import geopandas as gpd
-from shapely.geometry import MultiLineString, LineString, Point
+import numpy as np
+import requests
+import shapely
 
 import flight_log_tools.flight_log as fl
+from flight_log_tools.http_session import create_session
+from flight_log_tools.response_cache import ResponseCache
 
 colorama.init()
 
 class AeroAPIWrapper:
     """Class for interacting with AeroAPI version 4."""
-    def __init__(self):
+    def __init__(
+        self, rate=None, burst=None, max_workers=None, cache_ttl=None,
+    ):
+        """
+        Creates an AeroAPI wrapper.
+
+        rate is the number of requests allowed per second, and burst is
+        the number of requests which may be made at once before rate
+        limiting starts. max_workers is the number of flights fetched
+        concurrently by fetch_flights. Each defaults to the
+        AEROAPI_RATE, AEROAPI_BURST, and AEROAPI_MAX_WORKERS environment
+        variables if set, or else to values suitable for the Personal
+        tier.
+
+        cache_ttl is the number of seconds to cache responses for
+        flights which are not yet complete (0 disables caching them),
+        defaulting to the AEROAPI_CACHE_TTL environment variable or 300.
+        Responses for completed flights are always cached in the
+        response cache at AEROAPI_CACHE_PATH (or the default cache
+        path).
+        """
         self.api_key = os.getenv("AEROAPI_API_KEY")
         if self.api_key is None:
             raise KeyError("Environment variable AEROAPI_API_KEY is missing.")
         self.server = "https://aeroapi.flightaware.com/aeroapi"
-        self.timeout = 10
+        # (connect, read) timeouts in seconds for each endpoint. Tracks
+        # can be large, so allow more time to read them.
+        self.timeouts = {
+            'flights': (5, 10),
+            'track': (5, 30),
+        }
         self.isoformat = "%Y-%m-%dT%H:%M:%SZ"
 
-        # Set a wait time in seconds to avoid rate limiting on the
-        # Personal tier. If your account has a higher rate limit,
-        # you can set this to 0.
-        self.wait_time = 8
-        self.wait_until = None
-
-    def add_flight(self, ident, fields=None):
-        """Gets flight info for an ident and saves flight(s) to log."""
-        headers = {'x-apikey': self.api_key}
-        url = f"{self.server}/flights/{ident}"
-        params = {'ident_type': "fa_flight_id"}
-        self.wait()
-        response = requests.get(
-            url,
-            headers=headers,
-            params=params,
-            timeout=self.timeout,
+        # Default to one request every 8 seconds to avoid rate limiting
+        # on the Personal tier. If your account has a higher rate limit,
+        # you can increase the rate, or set it to 0 to disable rate
+        # limiting.
+        if rate is None:
+            rate = float(os.getenv("AEROAPI_RATE", 1 / 8))
+        if burst is None:
+            burst = int(os.getenv("AEROAPI_BURST", 1))
+        if max_workers is None:
+            max_workers = int(os.getenv("AEROAPI_MAX_WORKERS", 1))
+        self.rate_limiter = TokenBucket(rate, burst)
+        self.max_workers = max_workers
+        self.session = create_session(
+            headers={'x-apikey': self.api_key},
+            pool_size=max(max_workers, 10),
         )
-        print(f"🌐 GET {response.url}")
-        response.raise_for_status()
-        json_response = response.json()
-        flights = json_response['flights']
-        if len(flights) == 0:
-            print(
-                colorama.Fore.YELLOW
-                + f"AeroAPI returned 0 flights for {ident}."
-                + colorama.Style.RESET_ALL
+
+        # Completed flights never change, so their responses are cached
+        # permanently to avoid paying for repeat queries.
+        if cache_ttl is None:
+            cache_ttl = float(os.getenv("AEROAPI_CACHE_TTL", 300))
+        self.cache_ttl = cache_ttl
+        self.cache = ResponseCache(os.getenv("AEROAPI_CACHE_PATH"))
+
+        # Reference layer fids found for flights, keyed by (layer, code).
+        self.fids = {}
+
+    def add_flight(self, ident, fields=None, append=True):
+        """
+        Gets flight info for an ident and saves flight(s) to log.
+
+        If append is False, the record is only collected and returned
+        without being saved to the log. Returns None if no flight could
+        be added.
+        """
+        fetched = self.fetch_flight(ident)
+        if fetched is None:
+            return None
+        record = self.flight_record(*fetched, fields=fields)
+
+        # Append flight.
+        if append:
+            self.append_records([record])
+        return record
+
+    def add_flights(self, idents, fields=None, flights=None, append=True):
+        """
+        Gets flight info for multiple idents and saves them to the log.
+
+        Flights are fetched concurrently (see fetch_flights) and all
+        appended in a single batch, so the log is only written (and
+        routes only updated) once. If provided, fields is a list of dicts
+        of field values, and flights is a list of already known flight
+        dicts (or None), one per ident. If append is False, the records
+        are only collected and returned without being saved to the log.
+        Returns the list of records added.
+        """
+        if fields is None:
+            fields = [None] * len(idents)
+        records = [
+            self.flight_record(*fetched, fields=ident_fields)
+            for fetched, ident_fields
+            in zip(self.fetch_flights(idents, flights=flights), fields)
+            if fetched is not None
+        ]
+        if len(records) == 0:
+            print("No flights were added to the log.")
+            return records
+        if append:
+            self.append_records(records)
+        return records
+
+    @staticmethod
+    def append_records(records):
+        """Saves a list of flight records to the log in one batch."""
+        gdf = gpd.GeoDataFrame(records, geometry='geometry', crs="EPSG:4326")
+        fl.append_flights(gdf)
+
+    def fetch_flight(self, ident, flight=None):
+        """
+        Gets flight info and track for a completed flight.
+
+        If the flight dict is already known (such as from an earlier
+        ident search), it can be provided to avoid looking it up again.
+        Returns a tuple of the flight dict and track dict (which may be
+        None), or None if no completed flight was found.
+        """
+        if flight is None:
+            json_response = self.get_json(
+                f"/flights/{ident}",
+                {'ident_type': "fa_flight_id"},
+                'flights',
+                immutable=AeroAPIWrapper.all_complete,
             )
-            return
+            flights = json_response['flights']
+            if len(flights) == 0:
+                print(
+                    colorama.Fore.YELLOW
+                    + f"AeroAPI returned 0 flights for {ident}."
+                    + colorama.Style.RESET_ALL
+                )
+                return None
 
-        # AeroAPI may return more than one flight for an fa_flight_id
-        # if the flight was diverted. The flight without diverted status
-        # is the actual flight as shown.
-        flight = [f for f in flights if f['status'] != "Diverted"][0]
+            # AeroAPI may return more than one flight for an
+            # fa_flight_id if the flight was diverted. The flight
+            # without diverted status is the actual flight as shown.
+            flight = [f for f in flights if f['status'] != "Diverted"][0]
 
         # Check that flight is completed.
         progress = flight['progress_percent']
@@ -69,26 +172,88 @@ class AeroAPIWrapper:
                 + "Flight was not added to log."
                 + colorama.Style.RESET_ALL
             )
-            return
+            return None
 
         # Get geometry:
-        track_json = self.get_geometry(flight['fa_flight_id'])
+        track_json = self.get_geometry(flight['fa_flight_id'], complete=True)
+        return flight, track_json
+
+    def fetch_flights(self, idents, flights=None):
+        """
+        Gets flight info and tracks for multiple flights concurrently.
+
+        Up to max_workers flights are fetched at once, with each
+        worker requesting a flight and then its track, so requests are
+        only limited by the rate limiter. If provided, flights is a list
+        of already known flight dicts (or None), one per ident. Returns
+        a list in the same order as idents, with the same values as
+        fetch_flight. A flight which fails to be fetched (such as an
+        unknown ident) is None, so it does not prevent the others from
+        being added.
+        """
+        if flights is None:
+            flights = [None] * len(idents)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            return list(
+                executor.map(self._try_fetch_flight, idents, flights)
+            )
+
+    def _try_fetch_flight(self, ident, flight=None):
+        """
+        Gets flight info and track like fetch_flight, but returns None
+        with a warning if an AeroAPI request fails.
+        """
+        try:
+            return self.fetch_flight(ident, flight=flight)
+        except (requests.RequestException, ValueError) as e:
+            print(
+                colorama.Fore.YELLOW
+                + f"Could not fetch {ident} ({e}). "
+                + "Flight was not added to log."
+                + colorama.Style.RESET_ALL
+            )
+            return None
+
+    def find_fid(self, layer, code):
+        """
+        Finds a reference layer fid by code.
+
+        Results are reused for the life of the wrapper, so flights in a
+        batch sharing airports, airlines, or aircraft types only look
+        each code up (and warn about it) once.
+        """
+        key = (layer, code)
+        if key not in self.fids:
+            find = {
+                'aircraft_types': fl.find_aircraft_type_fid,
+                'airlines': fl.find_airline_fid,
+                'airports': fl.find_airport_fid,
+            }[layer]
+            self.fids[key] = find(code)
+        return self.fids[key]
+
+    def flight_record(self, flight, track_json, fields=None):
+        """Creates a flights layer record from AeroAPI flight info."""
         if track_json is None:
             print(
                 colorama.Fore.YELLOW,
-                f"No track found for {ident}",
+                f"No track found for {flight['fa_flight_id']}",
                 colorama.Style.RESET_ALL,
             )
             geom_mls = None
             track_dist_mi = None
         else:
             positions = track_json['positions']
-            track_ls = LineString([Point(
-                p['longitude'],
-                p['latitude'],
-                p['altitude']*30.48, # Convert 100s of feet to meters
-            ) for p in positions])
-            geom_mls = AeroAPIWrapper.split_antimeridian(track_ls)
+            coords = np.fromiter(
+                (
+                    (p['longitude'], p['latitude'], p['altitude'])
+                    for p in positions
+                ),
+                dtype=np.dtype((float, 3)),
+                count=len(positions),
+            )
+            coords[:, 2] *= 30.48 # Convert 100s of feet to meters
+            geom_mls = AeroAPIWrapper.split_antimeridian(coords)
             track_dist_mi = int(track_json['actual_distance'])
 
         # Create record.
@@ -97,16 +262,16 @@ class AeroAPIWrapper:
             'departure_utc': self.dep_utc(flight),
             'arrival_utc': self.arr_utc(flight),
             'flight_number': flight['flight_number'],
-            'origin_airport_fid': fl.find_airport_fid(
-                flight['origin']['code']
+            'origin_airport_fid': self.find_fid(
+                'airports', flight['origin']['code'],
             ),
-            'destination_airport_fid': fl.find_airport_fid(
-                flight['destination']['code']
+            'destination_airport_fid': self.find_fid(
+                'airports', flight['destination']['code'],
             ),
-            'aircraft_type_fid': fl.find_aircraft_type_fid(
-                flight['aircraft_type']
+            'aircraft_type_fid': self.find_fid(
+                'aircraft_types', flight['aircraft_type'],
             ),
-            'operator_fid': fl.find_airline_fid(flight['operator']),
+            'operator_fid': self.find_fid('airlines', flight['operator']),
             'tail_number': flight['registration'],
             'fa_flight_id': flight['fa_flight_id'],
             'fa_json': json.dumps(flight),
@@ -119,26 +284,16 @@ class AeroAPIWrapper:
         if fields is not None:
             for k, v in fields.items():
                 record[k] = v
-
-        # Append flight.
-        gdf = gpd.GeoDataFrame([record], geometry='geometry', crs="EPSG:4326")
-        fl.append_flights(gdf)
+        return record
 
     def get_flights_ident(self, ident, ident_type=None):
         """Gets flights matching an ident."""
-        headers = {'x-apikey': self.api_key}
-        url = f"{self.server}/flights/{ident}"
-        params = {'ident_type': ident_type}
-        self.wait()
-        response = requests.get(
-            url,
-            headers=headers,
-            params=params,
-            timeout=self.timeout,
+        json_response = self.get_json(
+            f"/flights/{ident}",
+            {'ident_type': ident_type},
+            'flights',
+            immutable=False,
         )
-        print(f"🌐 GET {response.url}")
-        response.raise_for_status()
-        json_response = response.json()
         return json_response['flights']
 
 
@@ -148,24 +303,23 @@ class AeroAPIWrapper:
             return None
         return time_val.strftime(self.isoformat)
 
-    def get_geometry(self, ident):
-        """Gets the track for a specific flight."""
-        url = f"{self.server}/flights/{ident}/track"
-        headers = {'x-apikey': self.api_key}
+    def get_geometry(self, ident, complete=False):
+        """
+        Gets the track for a specific flight.
+
+        Set complete to True if the flight is known to be complete, so
+        that its track can be cached permanently.
+        """
         params = {
             'include_estimated_positions': "true",
             'include_surface_positions': "true",
         }
-        self.wait()
-        response = requests.get(
-            url,
-            headers=headers,
-            params=params,
-            timeout=self.timeout,
+        track_json = self.get_json(
+            f"/flights/{ident}/track",
+            params,
+            'track',
+            immutable=complete,
         )
-        print(f"🌐 GET {response.url}")
-        response.raise_for_status()
-        track_json = response.json()
         if track_json is None:
             print(
                 colorama.Fore.YELLOW,
@@ -174,27 +328,55 @@ class AeroAPIWrapper:
             )
         return track_json
 
+    def get_json(self, endpoint, params, timeout_key, immutable=False):
+        """
+        Gets a JSON response from an AeroAPI endpoint.
+
+        Cached responses are returned without waiting for the rate
+        limiter. Responses are cached permanently if immutable is True,
+        or if immutable is a function that returns True when called
+        with the response. Other responses are cached for cache_ttl
+        seconds.
+        """
+        cached = self.cache.get(endpoint, params)
+        if cached is not None:
+            print(f"💾 GET {endpoint} (cached)")
+            return cached
+        self.wait()
+        response = self.session.get(
+            f"{self.server}{endpoint}",
+            params=params,
+            timeout=self.timeouts[timeout_key],
+        )
+        print(f"🌐 GET {response.url}")
+        response.raise_for_status()
+        json_response = response.json()
+        if json_response is not None:
+            if callable(immutable):
+                immutable = immutable(json_response)
+            self.cache.set(
+                endpoint,
+                params,
+                json_response,
+                ttl=None if immutable else self.cache_ttl,
+            )
+        return json_response
+
+    @staticmethod
+    def all_complete(json_response):
+        """Checks if a flights response only has completed flights."""
+        flights = json_response.get('flights', [])
+        return len(flights) > 0 and all(
+            f['progress_percent'] == 100 for f in flights
+        )
+
     def wait(self):
         """Delays requests to avoid AeroAPI rate limits."""
-        if self.wait_time == 0:
-            return
-        now = datetime.now(timezone.utc)
-
-        # On the first request, initialize and proceed.
-        if self.wait_until is None:
-            self.wait_until = now + timedelta(seconds=self.wait_time)
-            return
-
-        # If we're early, wait.
-        if now < self.wait_until:
-            sleep_seconds = (self.wait_until - now).total_seconds()
-            print(f"⏳ Waiting until {self.wait_until}")
-            time.sleep(sleep_seconds)
-
-        # Schedule the next wait.
-        self.wait_until = datetime.now(timezone.utc) + timedelta(
-            seconds=self.wait_time
-        )
+        delay = self.rate_limiter.reserve()
+        if delay > 0:
+            wait_until = datetime.now(timezone.utc) + timedelta(seconds=delay)
+            print(f"⏳ Waiting until {wait_until}")
+            time.sleep(delay)
 
     def arr_utc(self, flight_dict):
         """Gets the actual arrival time of a flight."""
@@ -214,62 +396,121 @@ class AeroAPIWrapper:
 
 
     @staticmethod
-    def split_antimeridian(track_ls: LineString):
-        """Split a LineString at the antimeridian."""
-        crossings = [
-            i + 1 for i, (p1, p2)
-            in enumerate(zip(track_ls.coords[:-1], track_ls.coords[1:]))
-            if (p1[0] < 0 and p2[0] >= 0) or (p1[0] >= 0 and p2[0] < 0)
-        ]
-
-        # Split the track at the indices.
-        if len(crossings) == 0:
-            geom = MultiLineString([track_ls])
-        else:
-            tracks = []
-            starts = [0, *crossings]
-            ends = [*crossings, len(track_ls.coords)-1]
-            tracks = [
-                track_ls.coords[start:end] for start, end in zip(starts, ends)
-            ]
-            for i, track in enumerate(tracks):
-                if i > 0:
-                    p1 = track[0]
-                    p2 = tracks[i-1][-1]
-                    p_cross = AeroAPIWrapper.__crossing_point(p1, p2)
-                    if p_cross is not None:
-                        track.insert(0, p_cross)
-                if i < len(crossings):
-                    p1 = track[-1]
-                    p2 = tracks[i+1][0]
-                    p_cross = AeroAPIWrapper.__crossing_point(p1, p2)
-                    if p_cross is not None:
-                        track.append(p_cross)
-
-            # Filter out tracks with only one point.
-            tracks = [track for track in tracks if len(track) > 1]
-
-            geom = MultiLineString(tracks)
-        return geom
+    def split_antimeridian(track):
+        """
+        Split a track at the antimeridian.
 
-    @staticmethod
-    def __crossing_point(p1, p2):
-        """Return the point where a track crosses the antemeridian.
-        Returns None if p1 is already on the antemeridian.
-
-        p1 : tuple(float)
-            The point on the current track
-        p2 : tuple(float)
-            The point on the adjacent track.
+        Takes a LineString or an (n, 2) or (n, 3) coordinate array, and
+        returns a MultiLineString with a part on each side of every
+        antimeridian crossing. Crossing vertices are interpolated (with
+        altitude, if present) and added to both adjacent parts.
         """
-        p2 = list(p2)
-        if -180 < p1[0] < 0:
-            lon = -180
-            p2[0] = p2[0] - 360
-        elif 0 < p1[0] < 180:
-            lon = 180
-            p2[0] = p2[0] + 360
+        if isinstance(track, shapely.Geometry):
+            coords = shapely.get_coordinates(track, include_z=track.has_z)
         else:
+            coords = np.asarray(track, dtype=float)
+        if len(coords) < 2:
             return None
-        x_frac = (lon - p1[0]) / (p2[0] - p1[0])
-        return tuple([c1 + (x_frac * (c2 - c1)) for c1, c2 in zip(p1, p2)])
+
+        # Find segments where longitude changes sign by more than 180
+        # degrees (crossing the antimeridian rather than the prime
+        # meridian).
+        x = coords[:, 0]
+        crossings = np.nonzero(
+            (np.diff(np.signbit(x).astype(np.int8)) != 0)
+            & (np.abs(np.diff(x)) > 180)
+        )[0]
+        if len(crossings) == 0:
+            return shapely.multilinestrings([shapely.linestrings(coords)])
+
+        # Interpolate crossing points, treating the longitude after the
+        # crossing as continuing past 180 degrees.
+        p1 = coords[crossings]
+        p2 = coords[crossings + 1].copy()
+        lon_before = np.where(x[crossings] < 0, -180.0, 180.0)
+        p2[:, 0] += 2 * lon_before
+        x_frac = (lon_before - p1[:, 0]) / (p2[:, 0] - p1[:, 0])
+        crossing_points = p1 + x_frac[:, np.newaxis] * (p2 - p1)
+        points_before = crossing_points.copy()
+        points_before[:, 0] = lon_before
+        points_after = crossing_points.copy()
+        points_after[:, 0] = -lon_before
+
+        # Add crossing points to the end of the part before each
+        # crossing and the start of the part after it, unless the track
+        # already has a point on the antimeridian there.
+        part_ids = np.zeros(len(coords), dtype=int)
+        part_ids[crossings + 1] = 1
+        part_ids = np.cumsum(part_ids)
+        add_before = x[crossings] != lon_before
+        add_after = x[crossings + 1] != -lon_before
+        insert_at = np.concatenate([
+            crossings[add_before] + 1, crossings[add_after] + 1,
+        ])
+        order = np.argsort(
+            np.concatenate([
+                2 * crossings[add_before], 2 * crossings[add_after] + 1,
+            ]),
+            kind="stable",
+        )
+        coords = np.insert(
+            coords,
+            insert_at[order],
+            np.concatenate([
+                points_before[add_before], points_after[add_after],
+            ])[order],
+            axis=0,
+        )
+        part_ids = np.insert(
+            part_ids,
+            insert_at[order],
+            np.concatenate([
+                part_ids[crossings[add_before]],
+                part_ids[crossings[add_after] + 1],
+            ])[order],
+        )
+
+        # Filter out parts with only one point.
+        keep = np.bincount(part_ids)[part_ids] > 1
+        _, part_ids = np.unique(part_ids[keep], return_inverse=True)
+        parts = shapely.linestrings(coords[keep], indices=part_ids)
+        return shapely.multilinestrings(parts)
+
+
+class TokenBucket:
+    """Thread-safe token bucket rate limiter."""
+    def __init__(self, rate, burst=1):
+        """
+        Creates a token bucket.
+
+        rate is the number of tokens added per second (0 disables rate
+        limiting), and burst is the maximum number of tokens the bucket
+        can hold.
+        """
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        """
+        Takes a token from the bucket.
+
+        Returns the number of seconds the caller must wait before using
+        the token. Tokens may be reserved ahead of time, so concurrent
+        callers are scheduled in order instead of all waking at once.
+        """
+        if self.rate <= 0:
+            return 0
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.burst,
+                self.tokens + (now - self.updated) * self.rate,
+            )
+            self.updated = now
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0
+            return -self.tokens / self.rate
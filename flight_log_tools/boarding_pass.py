@@ -1,6 +1,11 @@
 """Tools for interacting with boarding passes."""
 
-from datetime import datetime, date, timedelta
+import json
+import zipfile
+from array import array
+from collections.abc import Mapping
+from datetime import date, timedelta
+from functools import cache
 
 _BCBP_FIELDS = {
     "mandatory_unique": [
@@ -106,58 +111,149 @@ _BCBP_FIELDS = {
     ]
 }
 
+def _compile_layout(fields):
+    """
+    Precomputes the offsets of a block's fixed-length fields.
+
+    Returns a tuple of (key, start, stop) tuples, with offsets relative
+    to the start of the block. Stops at the first variable-length field.
+    """
+    layout = []
+    start = 0
+    for field in fields:
+        if field['length'] is None:
+            break
+        layout.append((field['key'], start, start + field['length']))
+        start += field['length']
+    return tuple(layout)
+
+# Field offsets for each block, compiled once from _BCBP_FIELDS.
+_BCBP_LAYOUTS = {
+    block: _compile_layout(fields) for block, fields in _BCBP_FIELDS.items()
+}
+# Total length of the fixed-length fields in each block.
+_BCBP_LAYOUT_LENGTHS = {
+    block: layout[-1][2] if len(layout) > 0 else 0
+    for block, layout in _BCBP_LAYOUTS.items()
+}
+
+# Keys of fields stored once per boarding pass and once per leg, in the
+# order they are parsed.
+_UNIQUE_KEYS = (
+    *(f['key'] for f in _BCBP_FIELDS['mandatory_unique']),
+    'legs',
+    *(f['key'] for f in _BCBP_FIELDS['conditional_unique']),
+    *(f['key'] for f in _BCBP_FIELDS['security']),
+    'unknown',
+)
+_LEG_KEYS = tuple(
+    f['key'] for block in [
+        'mandatory_repeated', 'conditional_repeated', 'airline_repeated',
+    ]
+    for f in _BCBP_FIELDS[block]
+)
+_UNIQUE_SLOTS = {key: i for i, key in enumerate(_UNIQUE_KEYS)}
+_LEG_SLOTS = {key: i for i, key in enumerate(_LEG_KEYS)}
+
+class BCBPFields(Mapping):
+    """
+    Read-only mapping of BCBP field keys to values.
+
+    Values are stored as start and stop offsets into the BCBP string,
+    and are only sliced from it when accessed. The fields of a boarding
+    pass (as opposed to a leg) also include a list of legs.
+    """
+    __slots__ = ('_source', '_keys', '_slots', '_bounds', 'legs')
+
+    def __init__(self, source, keys, slots):
+        self._source = source
+        self._keys = keys
+        self._slots = slots
+        self._bounds = array('i', [-1]) * (2 * len(keys))
+        self.legs = None
+
+    def __getitem__(self, key):
+        if key == 'legs' and self.legs is not None:
+            return self.legs
+        slot = self._slots[key]
+        start = self._bounds[2 * slot]
+        if start < 0:
+            raise KeyError(key)
+        return self._source[start:self._bounds[2 * slot + 1]]
+
+    def __iter__(self):
+        for key in self._keys:
+            if key == 'legs':
+                if self.legs is not None:
+                    yield key
+            elif self._bounds[2 * self._slots[key]] >= 0:
+                yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+    def set_span(self, key, start, stop):
+        """Sets a field's value to a slice of the BCBP string."""
+        slot = self._slots[key]
+        self._bounds[2 * slot] = start
+        self._bounds[2 * slot + 1] = stop
+
 class BoardingPass():
     """Represents a Bar-Coded Boarding Pass (BCBP)."""
+    __slots__ = (
+        'bcbp_str', 'data_len', 'raw', 'valid', 'version_number',
+        'leg_count', '_flight_dates',
+    )
+
     def __init__(self, bcbp_str):
         self.bcbp_str = bcbp_str
         self.data_len = len(self.bcbp_str)
-        self.raw = {}
+        self.raw = BCBPFields(bcbp_str, _UNIQUE_KEYS, _UNIQUE_SLOTS)
         self.valid = True
         self.version_number = None
+        self._flight_dates = None
         self.__parse()
 
     def __str__(self):
         return self.bcbp_str.replace(" ", "·")
 
+    @classmethod
+    def parse_many(cls, bcbp_strs):
+        """
+        Parses many BCBP strings, such as those from a scanner export.
+
+        Returns a list of BoardingPasses in the same order.
+        """
+        return list(map(cls, bcbp_strs))
+
     @property
     def flight_dates(self) -> list[date]:
         """Gets a list of flight dates for all legs."""
-        leg_dates = []
-        for leg in self.raw['legs']:
-            try:
-                date_ordinal = int(leg['flight_date'])
-                if date_ordinal > 366 or date_ordinal < 1:
-                    leg_dates.append(None)
-                    continue
-            except ValueError:
-                leg_dates.append(None)
-                continue
-            # Assume flight is up to 3 days in the future, or else the
-            # most recent date matching this ordinal in the past.
-            latest_dt = datetime.now() + timedelta(days=3)
-            latest_dt_year = latest_dt.timetuple().tm_year
-            latest_date = latest_dt.date()
-            # Loop through years in reverse trying to find a good date.
-            # Searches 8 years since leap years can be up to 8 years
-            # apart.
-            for year in range(latest_dt_year, latest_dt_year-8, -1):
-                test_date = date(year, 1, 1) + timedelta(days=date_ordinal-1)
-                if test_date.year != year:
-                    # The ordinal was larger than the number of days
-                    # this year, probably due to no leap year.
-                    continue
-                if test_date > latest_date:
-                    # The date this year is more than three days in the
-                    # future.
-                    continue
-                # This is the most recent date that works.
-                leg_dates.append(test_date)
-                break
-            else: # Loop did not break.
-                # No valid date was found.
-                leg_dates.append(None)
+        return self.resolve_flight_dates()
 
-        return leg_dates
+    def resolve_flight_dates(self, reference_date=None) -> list[date]:
+        """
+        Gets a list of flight dates for all legs.
+
+        BCBP flight dates only include the day of the year, so each date
+        is assumed to be up to 3 days after reference_date (defaulting
+        to today), or else the most recent matching date before it.
+        Dates are computed once per reference date and then reused.
+        """
+        if reference_date is None:
+            reference_date = date.today()
+        if self._flight_dates is None or (
+            self._flight_dates[0] != reference_date
+        ):
+            latest_date = reference_date + timedelta(days=3)
+            self._flight_dates = (reference_date, tuple(
+                _resolve_flight_date(leg['flight_date'], latest_date)
+                for leg in self.raw['legs']
+            ))
+        return list(self._flight_dates[1])
 
     def __parse(self):
         """Parses a boarding pass and returns a dict."""
@@ -174,11 +270,11 @@ class BoardingPass():
         # Set offset to end of mand_u block.
         cursor = mand_u_len
 
-        legs = []
-        self.raw['legs'] = []
+        self.raw.legs = []
         for leg_index in range(self.leg_count):
-            self.raw['legs'].append({})
-            leg_data = {}
+            self.raw.legs.append(
+                BCBPFields(self.bcbp_str, _LEG_KEYS, _LEG_SLOTS)
+            )
             # MANDATORY REPEATED
             mand_r_len = self.__parse_mand_r(cursor, leg_index)
 
@@ -226,9 +322,8 @@ class BoardingPass():
                 # Airline data exists.
                 self.__parse_airline(cursor, leg_end, leg_index)
 
-            # Set cursor to leg end and save leg data.
+            # Set cursor to leg end.
             cursor = leg_end
-            legs.append(leg_data)
 
         if cursor > self.data_len:
             # Boarding pass data had invalid lengths.
@@ -246,7 +341,7 @@ class BoardingPass():
 
         # LEFTOVER UNKNOWN DATA
         if cursor < self.data_len:
-            self.raw['unknown'] = self.bcbp_str[cursor:self.data_len]
+            self.raw.set_span('unknown', cursor, self.data_len)
 
         return
 
@@ -256,14 +351,9 @@ class BoardingPass():
 
         Returns the length of the block.
         """
-        raw = self.bcbp_str
-        fields = _BCBP_FIELDS['mandatory_unique']
-        lengths = [v['length'] for v in fields]
-        for i, f in enumerate(fields):
-            start = sum(lengths[0:i])
-            stop = start + f['length']
-            self.raw[f['key']] = raw[start:stop]
-        return sum(lengths)
+        for key, start, stop in _BCBP_LAYOUTS['mandatory_unique']:
+            self.raw.set_span(key, start, stop)
+        return _BCBP_LAYOUT_LENGTHS['mandatory_unique']
 
     def __parse_mand_r(self, offset, leg_index):
         """
@@ -271,21 +361,17 @@ class BoardingPass():
 
         Returns the length of the block.
         """
-        raw = self.bcbp_str
-        fields = _BCBP_FIELDS['mandatory_repeated']
-        lengths = [v['length'] for v in fields]
-        for i, f in enumerate(fields):
-            start = offset + sum(lengths[0:i])
-            stop = start + f['length']
-            self.raw['legs'][leg_index][f['key']] = raw[start:stop]
-        return sum(lengths)
+        leg = self.raw.legs[leg_index]
+        for key, start, stop in _BCBP_LAYOUTS['mandatory_repeated']:
+            leg.set_span(key, offset + start, offset + stop)
+        return _BCBP_LAYOUT_LENGTHS['mandatory_repeated']
 
     def __parse_cond_u(self, offset):
         """Parses a conditional unique block starting at offset."""
         return self.__parse_cond(
             offset,
             None, # Store unique outside of a leg
-            _BCBP_FIELDS['conditional_unique'],
+            _BCBP_LAYOUTS['conditional_unique'],
             'following_unique_length',
         )
 
@@ -294,11 +380,11 @@ class BoardingPass():
         return self.__parse_cond(
             offset,
             leg_index,
-            _BCBP_FIELDS['conditional_repeated'],
+            _BCBP_LAYOUTS['conditional_repeated'],
             'following_repeated_length',
         )
 
-    def __parse_cond(self, offset, leg_index, fields, following_length_key):
+    def __parse_cond(self, offset, leg_index, layout, following_length_key):
         """
         Parses a conditional block.
 
@@ -309,74 +395,130 @@ class BoardingPass():
         Returns the length of the block.
         """
         raw = self.bcbp_str
-        cond = {}
-        lengths = [v['length'] for v in fields]
-        fol_offset = None # Start of "following" block
-        fol_len = None # Length of "following" block
-        for i, f in enumerate(fields):
-            start = offset + sum(lengths[0:i])
-            stop = start + f['length']
-            if fol_len is not None:
-                remaining_size = fol_offset + fol_len - start
-                if remaining_size <= 0:
+        if leg_index is None:
+            values = self.raw
+        else:
+            values = self.raw.legs[leg_index]
+        fol_end = None # End of "following" block
+        for key, start, stop in layout:
+            start += offset
+            stop += offset
+            if fol_end is not None:
+                if fol_end <= start:
                     # No size remains.
                     break
-                if remaining_size < f['length']:
+                if fol_end < stop:
                     # Field is longer than remaining size; truncate.
-                    stop = start + remaining_size
-            value_str = raw[start:stop]
-            cond[f['key']] = value_str
-            if leg_index is None:
-                self.raw[f['key']] = value_str
-            else:
-                self.raw['legs'][leg_index][f['key']] = value_str
-            if f['key'] == following_length_key:
+                    stop = fol_end
+            values.set_span(key, start, stop)
+            if key == following_length_key:
                 # Parse the following field size.
                 try:
-                    fol_len = int(value_str, 16)
-                    fol_offset = stop
+                    fol_end = stop + int(raw[start:stop], 16)
                 except ValueError:
                     self.valid = False
                     return None
-        if fol_offset is None:
+        if fol_end is None:
             self.valid = False
             return None
-        return fol_offset + fol_len - offset # Length
+        return fol_end - offset # Length
 
     def __parse_airline(self, offset_start, offset_end, leg_index):
         """Parses airline data."""
-        raw = self.bcbp_str
         key = _BCBP_FIELDS['airline_repeated'][0]['key']
-        self.raw['legs'][leg_index][key] = raw[offset_start:offset_end]
+        self.raw.legs[leg_index].set_span(key, offset_start, offset_end)
         return
 
     def __parse_security(self, offset):
         """Parses security data."""
         raw = self.bcbp_str
-        fields = _BCBP_FIELDS['security']
+        data_key = _BCBP_FIELDS['security'][-1]['key']
         if raw[offset:offset+1] == "^":
             # Properly formatted security data.
-            lengths = [v['length'] for v in fields if v['length'] is not None]
-            for i, f in enumerate(fields[0:3]):
-                start = offset + sum(lengths[0:i])
-                stop = start + f['length']
-                self.raw[f['key']] = raw[start:stop]
+            for key, start, stop in _BCBP_LAYOUTS['security']:
+                self.raw.set_span(key, offset + start, offset + stop)
             # Get security data length from field 29.
             try:
                 sec_data_len = int(self.raw['security_data_length'], 16)
             except ValueError:
                 self.valid = False
                 return None
-            sec_offset = offset + sum(lengths)
+            sec_offset = offset + _BCBP_LAYOUT_LENGTHS['security']
             if sec_offset + sec_data_len > self.data_len:
                 sec_data_len = self.data_len - sec_offset
-            self.raw[fields[-1]['key']] = raw[
-                sec_offset:sec_offset+sec_data_len
-            ]
+            self.raw.set_span(
+                data_key, sec_offset, sec_offset + sec_data_len,
+            )
             length = (sec_offset - offset) + sec_data_len
         else:
             # Improperly formatted security data. Treat the rest of the
             # boarding pass as security data.
-            self.raw[fields[-1]['key']] = raw[offset:self.data_len]
+            self.raw.set_span(data_key, offset, self.data_len)
             length = self.data_len - offset
         return length
+
+@cache
+def _resolve_flight_date(flight_date, latest_date):
+    """
+    Gets the most recent date on or before latest_date with the BCBP
+    day of year flight_date.
+
+    Results are cached, so resolving the same day of year against the
+    same latest date (such as for a batch of boarding passes) is a
+    single dictionary lookup. Returns None if no valid date is found.
+    """
+    try:
+        date_ordinal = int(flight_date)
+    except ValueError:
+        return None
+    if date_ordinal > 366 or date_ordinal < 1:
+        return None
+    # Loop through years in reverse trying to find a good date.
+    # Searches 8 years since leap years can be up to 8 years apart.
+    for year in range(latest_date.year, latest_date.year-8, -1):
+        test_date = _ordinal_date(date_ordinal, year)
+        if test_date is None:
+            # The ordinal was larger than the number of days this year,
+            # probably due to no leap year.
+            continue
+        if test_date > latest_date:
+            # The date this year is more than three days in the future.
+            continue
+        # This is the most recent date that works.
+        return test_date
+    # No valid date was found.
+    return None
+
+@cache
+def _ordinal_date(date_ordinal, year):
+    """
+    Gets the date for a day of the year.
+
+    Returns None if the year does not have that many days.
+    """
+    test_date = date(year, 1, 1) + timedelta(days=date_ordinal-1)
+    if test_date.year != year:
+        return None
+    return test_date
+
+def read_pkpass_bcbp(pkpass_file):
+    """
+    Reads the barcode message from a PKPass (Apple Wallet) file.
+
+    pkpass_file may be a path or a file-like object. Only pass.json is
+    read from the archive. Returns None if the pass has no barcode
+    message.
+    """
+    with zipfile.ZipFile(pkpass_file) as pkpass:
+        with pkpass.open("pass.json") as pass_file:
+            pass_json = json.loads(pass_file.read().decode("utf-8-sig"))
+
+    # Newer passes list barcodes in 'barcodes'; older passes use a
+    # single 'barcode'.
+    barcodes = list(pass_json.get('barcodes') or [])
+    if pass_json.get('barcode') is not None:
+        barcodes.append(pass_json['barcode'])
+    for barcode in barcodes:
+        if barcode.get('message'):
+            return barcode['message']
+    return None
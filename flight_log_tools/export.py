@@ -0,0 +1,317 @@
+"""Tools for exporting flight log layers to other formats."""
+
+import contextlib
+import json
+import os
+import struct
+
+import colorama
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from pyogrio.raw import write_arrow
+from pyproj import CRS
+
+import flight_log_tools.flight_log as fl
+
+# Number of records read from the log and written at a time.
+BATCH_SIZE = 1000
+# Export formats for output file extensions.
+_EXTENSIONS = {
+    ".fgb": 'fgb',
+    ".geojsonl": 'geojsonseq',
+    ".geojsons": 'geojsonseq',
+    ".geoparquet": 'parquet',
+    ".parquet": 'parquet',
+}
+# GDAL drivers and layer creation options for the formats written with
+# GDAL. GeoParquet is written with pyarrow instead, so it does not
+# depend on GDAL's optional Parquet driver.
+_GDAL_FORMATS = {
+    'fgb': ("FlatGeobuf", {'SPATIAL_INDEX': "YES"}),
+    'geojsonseq': ("GeoJSONSeq", {}),
+}
+# Geometry type names used by GeoParquet and pyogrio for each GeoPackage
+# geometry type, in WKB type code order.
+_GEOMETRY_TYPES = {
+    'POINT': "Point",
+    'LINESTRING': "LineString",
+    'POLYGON': "Polygon",
+    'MULTIPOINT': "MultiPoint",
+    'MULTILINESTRING': "MultiLineString",
+    'MULTIPOLYGON': "MultiPolygon",
+    'GEOMETRYCOLLECTION': "GeometryCollection",
+}
+
+def export_layer(
+    layer, path, file_format=None, changed=False, changes_path=None,
+    batch_size=BATCH_SIZE,
+):
+    """
+    Exports a layer to a GeoParquet, FlatGeobuf, or GeoJSONSeq file.
+
+    file_format is 'parquet', 'fgb', or 'geojsonseq', and is found from
+    the file extension if None. Records are streamed from the log in
+    Arrow record batches of batch_size records, so the whole layer is
+    never held in memory.
+
+    If changed is True, the first export of the layer to path with
+    changed set exports every record to path, as usual. Later ones leave
+    path as it is, and export the records added or edited since the last
+    one to changes_path (by default the path with .changes added before
+    its extension), along with a record for each deleted fid. Records in
+    the changes file have a 'deleted' column, which is True for deleted
+    records, whose other columns are null. Files are only replaced once
+    the export is complete.
+    """
+    if file_format is None:
+        extension = os.path.splitext(path)[1].lower()
+        if extension not in _EXTENSIONS:
+            raise ValueError(
+                f"Cannot find an export format for '{extension}' files. "
+                "Use a format option or one of these extensions: "
+                f"{', '.join(_EXTENSIONS)}"
+            )
+        file_format = _EXTENSIONS[extension]
+    target = os.path.abspath(path)
+    if changes_path is None:
+        root, extension = os.path.splitext(target)
+        changes_path = f"{root}.changes{extension}"
+    changes_path = os.path.abspath(changes_path)
+
+    # Tracking and recording changes writes to the GeoPackage.
+    with fl.transaction(immediate=changed):
+        changes = None
+        if changed:
+            changes = fl.find_layer_changes(layer, target)
+        is_delta = changes is not None and changes['changed'] is not None
+        schema = fl.layer_schema(layer)
+        arrow_schema = _arrow_schema(schema, with_deleted=is_delta)
+        counts = {'exported': 0, 'skipped': 0}
+
+        def batches():
+            for rows in fl.read_layer_batches(
+                layer,
+                batch_size=batch_size,
+                fids=changes['changed'] if is_delta else None,
+            ):
+                batch = _record_batch(rows, arrow_schema)
+                if file_format == 'fgb' and not is_delta:
+                    # FlatGeobuf's spatial index cannot contain records
+                    # without geometry.
+                    has_geometry = pc.is_valid(batch.column("geometry"))
+                    counts['skipped'] += batch.num_rows
+                    batch = batch.filter(has_geometry)
+                    counts['skipped'] -= batch.num_rows
+                counts['exported'] += batch.num_rows
+                yield batch
+            if is_delta and len(changes['deleted']) > 0:
+                yield _deleted_batch(changes['deleted'], arrow_schema)
+
+        _write_file(
+            changes_path if is_delta else target,
+            file_format,
+            layer,
+            schema,
+            arrow_schema,
+            batches(),
+            # Changes files include deleted records without geometry,
+            # which a FlatGeobuf spatial index cannot contain.
+            spatial_index=not is_delta,
+        )
+        if changes is not None:
+            fl.record_layer_export(layer, target, changes['seq'])
+
+    if counts['skipped'] > 0:
+        print(
+            colorama.Fore.YELLOW
+            + f"{counts['skipped']} record(s) without geometry were not "
+            + "exported, since FlatGeobuf files with a spatial index "
+            + "cannot contain them."
+            + colorama.Style.RESET_ALL
+        )
+    if not is_delta:
+        print(
+            f"Exported {counts['exported']} record(s) from '{layer}' to "
+            f"{path}."
+        )
+        return
+    print(
+        f"Exported {counts['exported']} changed and "
+        f"{len(changes['deleted'])} deleted record(s) from '{layer}' since "
+        f"the last export to {path}, to {changes_path}."
+    )
+
+def _arrow_schema(schema, with_deleted=False):
+    """
+    Creates an Arrow schema for a layer.
+
+    Takes a layer schema from flight_log.layer_schema. Attribute columns
+    get Arrow types matching their GeoPackage types, and the geometry is
+    stored as WKB in a 'geometry' column. If with_deleted is True, a
+    'deleted' column follows the attribute columns.
+    """
+    fields = [pa.field(schema['fid'], pa.int64(), nullable=False)]
+    for column in schema['columns']:
+        fields.append(pa.field(column, _arrow_type(schema['types'][column])))
+    if with_deleted:
+        fields.append(pa.field("deleted", pa.bool_(), nullable=False))
+    if schema['geometry'] is not None:
+        fields.append(pa.field("geometry", pa.binary()))
+    return pa.schema(fields)
+
+def _arrow_type(sql_type):
+    """Gets the Arrow type for a GeoPackage column type."""
+    if sql_type == "BOOLEAN":
+        return pa.bool_()
+    if "INT" in sql_type:
+        return pa.int64()
+    if sql_type in ("DOUBLE", "FLOAT", "REAL"):
+        return pa.float64()
+    if sql_type == "DATE":
+        return pa.date32()
+    if sql_type == "DATETIME":
+        return pa.timestamp("ms", tz="UTC")
+    if sql_type == "BLOB":
+        return pa.binary()
+    return pa.string()
+
+def _deleted_batch(fids, arrow_schema):
+    """
+    Creates an Arrow record batch of deleted records.
+
+    Each record has a fid, True in the 'deleted' column, and nulls in
+    every other column.
+    """
+    fids = sorted(fids)
+    arrays = []
+    for field in arrow_schema:
+        if field.name == arrow_schema[0].name:
+            arrays.append(pa.array(fids, field.type))
+        elif field.name == "deleted":
+            arrays.append(pa.array([True] * len(fids), field.type))
+        else:
+            arrays.append(pa.nulls(len(fids), field.type))
+    return pa.RecordBatch.from_arrays(arrays, schema=arrow_schema)
+
+def _geometry_type(schema):
+    """
+    Gets the geometry type name of a layer, such as 'MultiLineString Z'.
+
+    Returns None if the layer allows mixed geometry types or optional Z
+    values.
+    """
+    geometry_type = _GEOMETRY_TYPES.get(schema['geometry_type'])
+    if geometry_type is None or schema['z'] == 2:
+        return None
+    return geometry_type + (" Z" if schema['z'] == 1 else "")
+
+def _record_batch(rows, arrow_schema):
+    """
+    Creates an Arrow record batch from rows of raw layer values.
+
+    Values are converted to the types in the Arrow schema. If the schema
+    has a 'deleted' column, it is False for every row.
+    """
+    columns = list(zip(*rows))
+    if "deleted" in arrow_schema.names:
+        columns.insert(
+            arrow_schema.get_field_index("deleted"), [False] * len(rows),
+        )
+    arrays = []
+    for field, values in zip(arrow_schema, columns):
+        if pa.types.is_boolean(field.type):
+            values = [None if v is None else bool(v) for v in values]
+        if pa.types.is_timestamp(field.type) or pa.types.is_date(field.type):
+            # SQLite stores dates and times as ISO 8601 text.
+            arrays.append(pa.array(values, pa.string()).cast(field.type))
+        else:
+            arrays.append(pa.array(values, field.type))
+    return pa.RecordBatch.from_arrays(arrays, schema=arrow_schema)
+
+def _write_file(
+    path, file_format, layer, schema, arrow_schema, batches,
+    spatial_index=True,
+):
+    """
+    Writes record batches to an export file.
+
+    The batches are written to a temporary file, which replaces the file
+    at path once it is complete. spatial_index is only used for
+    FlatGeobuf files.
+    """
+    # Keep the extension on the temporary file, since GDAL drivers use it
+    # to decide whether to create a file or a folder.
+    root, extension = os.path.splitext(path)
+    temp_path = f"{root}.tmp{extension}"
+    try:
+        if file_format == 'parquet':
+            _write_geoparquet(temp_path, schema, arrow_schema, batches)
+        else:
+            driver, layer_options = _GDAL_FORMATS[file_format]
+            if file_format == 'fgb' and not spatial_index:
+                layer_options = {**layer_options, 'SPATIAL_INDEX': "NO"}
+            write_arrow(
+                pa.RecordBatchReader.from_batches(arrow_schema, batches),
+                temp_path,
+                layer=layer,
+                driver=driver,
+                geometry_name="geometry",
+                geometry_type=_geometry_type(schema) or "Unknown",
+                crs=f"EPSG:{schema['srs_id']}",
+                layer_options=layer_options,
+            )
+        os.replace(temp_path, path)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(temp_path)
+        raise
+
+def _write_geoparquet(path, schema, arrow_schema, batches):
+    """
+    Writes record batches to a GeoParquet file.
+
+    Each batch is written as a row group. GeoParquet metadata describing
+    the WKB geometry column is written once all batches are, so it can
+    list the geometry types found in them.
+    """
+    geometry_types = set()
+    with pq.ParquetWriter(path, arrow_schema) as writer:
+        for batch in batches:
+            # Geometry types only need the byte order and type code at
+            # the start of each WKB geometry.
+            wkb_headers = pc.unique(
+                pc.binary_slice(batch.column("geometry"), 0, 5)
+            )
+            geometry_types.update(
+                _wkb_geometry_type(header)
+                for header in wkb_headers.to_pylist() if header is not None
+            )
+            writer.write_batch(batch)
+        geo = {
+            'version': "1.1.0",
+            'primary_column': "geometry",
+            'columns': {
+                'geometry': {
+                    'encoding': "WKB",
+                    'geometry_types': sorted(geometry_types - {None}),
+                    'crs': CRS.from_epsg(schema['srs_id']).to_json_dict(),
+                },
+            },
+        }
+        writer.add_key_value_metadata({'geo': json.dumps(geo)})
+
+def _wkb_geometry_type(wkb):
+    """
+    Gets the geometry type name from the start of a WKB geometry.
+
+    Returns None for types which GeoParquet does not list (those with M
+    values).
+    """
+    byte_order = "<" if wkb[0] == 1 else ">"
+    type_code = struct.unpack_from(f"{byte_order}I", wkb, 1)[0]
+    dimensions, base_code = divmod(type_code, 1000)
+    if dimensions not in (0, 1) or not 1 <= base_code <= 7:
+        return None
+    geometry_type = list(_GEOMETRY_TYPES.values())[base_code - 1]
+    return geometry_type + (" Z" if dimensions == 1 else "")
@@ -1,216 +1,845 @@
 """Scripts for interacting with the flight log."""
 
 # Standard imports
+import atexit
+import contextlib
+import hashlib
+import json
 import os
 import sqlite3
-from math import ceil
+import struct
+import zlib
 
 # Third-party imports
 import colorama
 import geopandas as gpd
+import numpy as np
 import pandas as pd
 from pyproj import Geod
-from shapely.geometry import Point, LineString, MultiLineString
+import shapely
 
 METERS_PER_MILE = 1609.344
 METERS_BETWEEN_GC_POINTS = 100000
+# Douglas-Peucker tolerances in degrees for the simplified_tracks layer,
+# from finest to coarsest (roughly 100 m, 1 km, and 10 km).
+SIMPLIFY_TOLERANCES = [0.001, 0.01, 0.1]
 
-colorama.init()
+# Table logging the fids of records changed in layers tracked for
+# incremental exports.
+_CHANGES_TABLE = "layer_changes"
+# Code columns to search on each reference layer, in lookup order.
+_CODE_COLUMNS = {
+    'aircraft_types': ['icao_code', 'iata_code'],
+    'airlines': ['icao_code', 'iata_code'],
+    'airports': ['icao_code', 'iata_code', 'faa_lid'],
+}
+# Table storing zlib compressed fa_json payloads of flights, once they
+# have been compressed.
+_COMPRESSED_FA_JSON_TABLE = "compressed_fa_json"
+# Table storing the last change exported from each layer to each target.
+_EXPORTS_TABLE = "layer_exports"
+_GEOD = Geod(ellps="WGS84")
+# Table storing hashes of files which have been imported.
+_IMPORTED_FILES_TABLE = "imported_files"
+# Columns to keep indexed on each layer, so lookups by code or flight
+# ID don't scan the whole layer.
+_INDEXED_COLUMNS = {
+    **_CODE_COLUMNS,
+    'flights': ['fa_flight_id', 'fh_id', 'trip_fid'],
+    'simplified_tracks': ['flight_fid'],
+}
+# Pragmas set on the shared GeoPackage connection. WAL journaling lets
+# other programs (such as GIS software) read the log while it is being
+# written.
+_PRAGMAS = {
+    'journal_mode': "WAL",
+    'synchronous': "NORMAL",
+    'cache_size': -65536, # 64 MiB
+    'mmap_size': 268435456, # 256 MiB
+}
+# Shapely predicates which can be used to query layers. Each is only
+# true for features whose bounding boxes intersect the query region.
+_QUERY_PREDICATES = [
+    'contains', 'covered_by', 'covers', 'crosses', 'intersects', 'overlaps',
+    'touches', 'within',
+]
+# Table storing previously generated great circle route geometry.
+_ROUTE_CACHE_TABLE = "route_geometry_cache"
+# Summary tables of flight statistics. Each has key columns, count
+# columns, and a query aggregating the flights matching {where} (with
+# alias f) into counts for each key. Airport visits are counted once per
+# trip section, so layovers are not counted twice. Flights without a
+# trip section are counted as their own section. {existing} matches
+# flights (with alias e) which were counted before the aggregated ones.
+_STATS_TABLES = {
+    'stats_aircraft_types': {
+        'keys': [('aircraft_type_fid', "INTEGER")],
+        'counts': ['flight_count'],
+        'select': """
+            SELECT f.aircraft_type_fid, COUNT(*) FROM flights AS f
+            WHERE {where} AND f.aircraft_type_fid IS NOT NULL
+            GROUP BY f.aircraft_type_fid
+        """,
+    },
+    'stats_airlines': {
+        'keys': [('airline_fid', "INTEGER")],
+        'counts': ['flight_count', 'operated_count'],
+        'select': """
+            SELECT airline_fid, SUM(is_airline), SUM(is_operator) FROM (
+                SELECT f.airline_fid, 1 AS is_airline, 0 AS is_operator
+                FROM flights AS f WHERE {where}
+                UNION ALL
+                SELECT f.operator_fid, 0, 1 FROM flights AS f WHERE {where}
+            )
+            WHERE airline_fid IS NOT NULL
+            GROUP BY airline_fid
+        """,
+    },
+    'stats_airports': {
+        'keys': [('airport_fid', "INTEGER")],
+        'counts': ['visit_count'],
+        'select': """
+            SELECT airport_fid, COUNT(DISTINCT section) FROM (
+                SELECT f.origin_airport_fid AS airport_fid, f.trip_fid,
+                    f.trip_section, coalesce(
+                        f.trip_fid || ':' || f.trip_section, 'flight ' || f.fid
+                    ) AS section
+                FROM flights AS f WHERE {where}
+                UNION ALL
+                SELECT f.destination_airport_fid, f.trip_fid, f.trip_section,
+                    coalesce(
+                        f.trip_fid || ':' || f.trip_section, 'flight ' || f.fid
+                    )
+                FROM flights AS f WHERE {where}
+            ) AS v
+            WHERE airport_fid IS NOT NULL AND NOT EXISTS (
+                SELECT 1 FROM flights AS e
+                WHERE e.trip_fid = v.trip_fid
+                    AND e.trip_section = v.trip_section
+                    AND v.airport_fid IN (
+                        e.origin_airport_fid, e.destination_airport_fid
+                    )
+                    AND {existing}
+            )
+            GROUP BY airport_fid
+        """,
+    },
+    'stats_routes': {
+        'keys': [('airport_1_fid', "INTEGER"), ('airport_2_fid', "INTEGER")],
+        'counts': ['flight_count'],
+        'select': """
+            SELECT
+                min(f.origin_airport_fid, f.destination_airport_fid),
+                max(f.origin_airport_fid, f.destination_airport_fid),
+                COUNT(*)
+            FROM flights AS f
+            WHERE {where} AND f.origin_airport_fid IS NOT NULL
+                AND f.destination_airport_fid IS NOT NULL
+            GROUP BY 1, 2
+        """,
+    },
+    'stats_tail_numbers': {
+        'keys': [('tail_number', "TEXT")],
+        'counts': ['flight_count'],
+        'select': """
+            SELECT f.tail_number, COUNT(*) FROM flights AS f
+            WHERE {where} AND f.tail_number IS NOT NULL
+            GROUP BY f.tail_number
+        """,
+    },
+    'stats_years': {
+        'keys': [('year', "INTEGER")],
+        'counts': ['flight_count', 'distance_mi'],
+        'select': """
+            SELECT CAST(strftime('%Y', f.departure_utc) AS INTEGER),
+                COUNT(*), coalesce(SUM(f.distance_mi), 0)
+            FROM flights AS f
+            WHERE {where} AND f.departure_utc IS NOT NULL
+            GROUP BY 1
+        """,
+    },
+}
+# Queries reading summaries from the statistics tables, by title. Each
+# takes a :limit parameter for the number of rows to show.
+_STATS_QUERIES = {
+    'Flights by Year': """
+        SELECT y.year AS "Year", y.flight_count AS "Flights",
+            y.distance_mi AS "Miles", coalesce(t.trip_count, 0) AS "Trips"
+        FROM stats_years AS y
+        LEFT JOIN (
+            SELECT CAST(strftime('%Y', start_date) AS INTEGER) AS year,
+                COUNT(*) AS trip_count
+            FROM trips GROUP BY 1
+        ) AS t ON t.year = y.year
+        ORDER BY y.year
+    """,
+    'Top Airports': """
+        SELECT coalesce(a.iata_code, a.icao_code, a.faa_lid) AS "Code",
+            a.name AS "Airport", s.visit_count AS "Visits"
+        FROM stats_airports AS s
+        LEFT JOIN airports AS a ON a.fid = s.airport_fid
+        ORDER BY s.visit_count DESC, "Code"
+        LIMIT :limit
+    """,
+    'Top Routes': """
+        SELECT coalesce(a1.iata_code, a1.icao_code, a1.faa_lid)
+                || ' – ' || coalesce(a2.iata_code, a2.icao_code, a2.faa_lid)
+                AS "Route",
+            s.flight_count AS "Flights"
+        FROM stats_routes AS s
+        LEFT JOIN airports AS a1 ON a1.fid = s.airport_1_fid
+        LEFT JOIN airports AS a2 ON a2.fid = s.airport_2_fid
+        ORDER BY s.flight_count DESC, "Route"
+        LIMIT :limit
+    """,
+    'Top Airlines': """
+        SELECT a.name AS "Airline", s.flight_count AS "Flights",
+            s.operated_count AS "Operated"
+        FROM stats_airlines AS s
+        LEFT JOIN airlines AS a ON a.fid = s.airline_fid
+        ORDER BY s.flight_count DESC, s.operated_count DESC, "Airline"
+        LIMIT :limit
+    """,
+    'Top Aircraft Families': """
+        SELECT coalesce(t.family, t.name) AS "Family",
+            SUM(s.flight_count) AS "Flights"
+        FROM stats_aircraft_types AS s
+        LEFT JOIN aircraft_types AS t ON t.fid = s.aircraft_type_fid
+        GROUP BY 1
+        ORDER BY "Flights" DESC, "Family"
+        LIMIT :limit
+    """,
+    'Top Tail Numbers': """
+        SELECT tail_number AS "Tail Number", flight_count AS "Flights"
+        FROM stats_tail_numbers
+        ORDER BY flight_count DESC, tail_number
+        LIMIT :limit
+    """,
+}
+# Triggers which maintain the R-tree spatial index of a layer's geometry
+# column, as created by GDAL.
+_RTREE_TRIGGERS = {
+    'insert': """
+        AFTER INSERT ON "{layer}"
+        WHEN (NEW."{geom}" NOT NULL AND NOT ST_IsEmpty(NEW."{geom}"))
+        BEGIN
+            INSERT OR REPLACE INTO "rtree_{layer}_{geom}" VALUES (
+                NEW."{fid}", ST_MinX(NEW."{geom}"), ST_MaxX(NEW."{geom}"),
+                ST_MinY(NEW."{geom}"), ST_MaxY(NEW."{geom}")
+            );
+        END
+    """,
+    'update2': """
+        AFTER UPDATE OF "{geom}" ON "{layer}"
+        WHEN OLD."{fid}" = NEW."{fid}"
+            AND (NEW."{geom}" ISNULL OR ST_IsEmpty(NEW."{geom}"))
+        BEGIN
+            DELETE FROM "rtree_{layer}_{geom}" WHERE id = OLD."{fid}";
+        END
+    """,
+    'update4': """
+        AFTER UPDATE ON "{layer}"
+        WHEN OLD."{fid}" != NEW."{fid}"
+            AND (NEW."{geom}" ISNULL OR ST_IsEmpty(NEW."{geom}"))
+        BEGIN
+            DELETE FROM "rtree_{layer}_{geom}"
+            WHERE id IN (OLD."{fid}", NEW."{fid}");
+        END
+    """,
+    'update5': """
+        AFTER UPDATE ON "{layer}"
+        WHEN OLD."{fid}" != NEW."{fid}"
+            AND (NEW."{geom}" NOT NULL AND NOT ST_IsEmpty(NEW."{geom}"))
+        BEGIN
+            DELETE FROM "rtree_{layer}_{geom}" WHERE id = OLD."{fid}";
+            INSERT OR REPLACE INTO "rtree_{layer}_{geom}" VALUES (
+                NEW."{fid}", ST_MinX(NEW."{geom}"), ST_MaxX(NEW."{geom}"),
+                ST_MinY(NEW."{geom}"), ST_MaxY(NEW."{geom}")
+            );
+        END
+    """,
+    'update6': """
+        AFTER UPDATE OF "{geom}" ON "{layer}"
+        WHEN OLD."{fid}" = NEW."{fid}"
+            AND (NEW."{geom}" NOT NULL AND NOT ST_IsEmpty(NEW."{geom}"))
+            AND (OLD."{geom}" NOT NULL AND NOT ST_IsEmpty(OLD."{geom}"))
+        BEGIN
+            UPDATE "rtree_{layer}_{geom}" SET
+                minx = ST_MinX(NEW."{geom}"), maxx = ST_MaxX(NEW."{geom}"),
+                miny = ST_MinY(NEW."{geom}"), maxy = ST_MaxY(NEW."{geom}")
+            WHERE id = NEW."{fid}";
+        END
+    """,
+    'update7': """
+        AFTER UPDATE OF "{geom}" ON "{layer}"
+        WHEN OLD."{fid}" = NEW."{fid}"
+            AND (NEW."{geom}" NOT NULL AND NOT ST_IsEmpty(NEW."{geom}"))
+            AND (OLD."{geom}" ISNULL OR ST_IsEmpty(OLD."{geom}"))
+        BEGIN
+            INSERT INTO "rtree_{layer}_{geom}" VALUES (
+                NEW."{fid}", ST_MinX(NEW."{geom}"), ST_MaxX(NEW."{geom}"),
+                ST_MinY(NEW."{geom}"), ST_MaxY(NEW."{geom}")
+            );
+        END
+    """,
+    'delete': """
+        AFTER DELETE ON "{layer}"
+        WHEN OLD."{geom}" NOT NULL
+        BEGIN
+            DELETE FROM "rtree_{layer}_{geom}" WHERE id = OLD."{fid}";
+        END
+    """,
+}
+_con = None
 
-flight_log = os.getenv("FLIGHT_LOG_GEOPACKAGE_PATH")
-if flight_log is None:
-    raise KeyError(
-        "Environment variable FLIGHT_LOG_GEOPACKAGE_PATH is missing."
-    )
+colorama.init()
 
 def append_flights(record_gdf):
     """Appends a GeoDataFrame of records to flights."""
     layer = "flights"
+    with transaction(immediate=True) as con:
+        # Ensure columns match existing structure. The GeoDataFrame's
+        # geometry is written to the layer's geometry column.
+        existing_cols = _layer_schema(con, layer)['columns']
+        geom_col = record_gdf.geometry.name
+        incoming_cols = [c for c in record_gdf.columns if c != geom_col]
 
-    # Ensure columns match existing structure.
-    existing = gpd.read_file(
-        flight_log,
-        layer=layer,
-        engine="pyogrio",
-        rows=0,
-    )
-    existing_cols = list(existing.columns)
-    incoming_cols = list(record_gdf.columns)
-
-    # Check that geometry column name matches.
-    geom_col = record_gdf.geometry.name
-    if geom_col not in existing_cols:
-        raise ValueError(
-            f"Geometry column '{geom_col}' not found in existing "
-            "layer schema"
-        )
+        # Check for columns in new data not in current schema.
+        extra_cols = set(incoming_cols) - set(existing_cols)
+        if extra_cols:
+            raise ValueError(
+                "Incoming data has columns not present in layer "
+                f"schema: {extra_cols}"
+            )
+
+        # Add missing columns from existing schema as null values.
+        for col in existing_cols:
+            if col not in record_gdf.columns:
+                record_gdf[col] = None
+                print(
+                    f"No value was provided for column '{col}'; setting "
+                    "its value to null."
+                )
+
+        # Reorder columns to match existing schema.
+        gdf = record_gdf[[geom_col, *existing_cols]]
 
-    # Check for columns in new data not in current schema.
-    extra_cols = set(incoming_cols) - set(existing_cols)
-    if extra_cols:
-        raise ValueError(
-            "Incoming data has columns not present in layer "
-            f"schema: {extra_cols}"
+        # Append data to geopackage layer.
+        last_fid = con.execute(
+            "SELECT coalesce(max(fid), 0) FROM flights"
+        ).fetchone()[0]
+        _insert_features(con, layer, gdf)
+        new_fids = [
+            row[0] for row in con.execute(
+                "SELECT fid FROM flights WHERE fid > ?", (last_fid,),
+            )
+        ]
+        if _fa_json_compressed(con):
+            _move_fa_json(con, new_fids)
+        print(
+            f"Appended {len(record_gdf)} flights(s) to '{layer}' in "
+            f"{geopackage_path()}."
         )
+        _add_routes(gdf)
+        update_simplified_tracks(fids=new_fids)
+        _add_stats(con, new_fids)
 
-    # Add missing columns from existing schema as null values.
-    for col in existing_cols:
-        if col not in record_gdf.columns:
-            record_gdf[col] = None
+def compress_fa_json(decompress=False):
+    """
+    Moves the fa_json payloads of flights into compressed storage.
+
+    Payloads are compressed with zlib into a separate table keyed by
+    flight fid and cleared from the flights table, so reading other
+    columns of flights no longer reads them. read_layer and
+    read_layer_batches still return them as fa_json, and payloads of
+    appended flights are compressed as well once any are. If decompress
+    is True, payloads are moved back into the flights table and the
+    compressed table is removed instead.
+    """
+    table = _COMPRESSED_FA_JSON_TABLE
+    with transaction(immediate=True) as con:
+        if decompress:
+            con.execute(f'DROP TRIGGER IF EXISTS "{table}_delete"')
+            if not _fa_json_compressed(con):
+                print("No fa_json payloads are compressed.")
+                return
+            count = con.execute(f"""
+                UPDATE flights SET fa_json = (
+                    SELECT zlib_decompress(data) FROM {table}
+                    WHERE flight_fid = flights.fid
+                )
+                WHERE fa_json ISNULL
+                    AND fid IN (SELECT flight_fid FROM {table})
+            """).rowcount
+            con.execute(f"DROP TABLE {table}")
             print(
-                f"No value was provided for column '{col}'; setting "
-                "its value to null."
+                f"Decompressed {count} fa_json payload(s) in "
+                f"{geopackage_path()}."
             )
+            return
 
-    # Reorder columns to match existing schema.
-    gdf = record_gdf[existing_cols]
-
-    # Append data to geopackage layer.
-    gdf.to_file(
-        flight_log,
-        driver="GPKG",
-        engine="pyogrio",
-        layer=layer,
-        mode="a",
-    )
+        con.execute(f"""
+            CREATE TABLE IF NOT EXISTS {table} (
+                flight_fid INTEGER PRIMARY KEY,
+                data BLOB NOT NULL
+            )
+        """)
+        # Remove payloads of deleted flights, including flights deleted
+        # by other programs.
+        con.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS "{table}_delete"
+            AFTER DELETE ON flights
+            BEGIN
+                DELETE FROM {table} WHERE flight_fid = OLD.fid;
+            END
+        """)
+        text_bytes = con.execute(
+            "SELECT coalesce(sum(length(CAST(fa_json AS BLOB))), 0) "
+            "FROM flights"
+        ).fetchone()[0]
+        count = _move_fa_json(con)
+        compressed_bytes = con.execute(
+            f"SELECT coalesce(sum(length(data)), 0) FROM {table}"
+        ).fetchone()[0]
     print(
-        f"Appended {len(record_gdf)} flights(s) to '{layer}' in {flight_log}."
+        f"Compressed {count} fa_json payload(s) ({text_bytes:,} bytes) in "
+        f"{geopackage_path()}. Compressed payloads total "
+        f"{compressed_bytes:,} bytes."
     )
-    update_routes()
+
+def ensure_indexes():
+    """
+    Creates any missing lookup indexes.
+
+    Missing indexes are also created whenever the GeoPackage is opened.
+    Returns a list of (layer, column, index name) tuples for each lookup
+    index. Columns which do not exist in the log are skipped.
+    """
+    with transaction(immediate=True) as con:
+        return _create_indexes(con)
+
+def ensure_spatial_index(layer, rebuild=False):
+    """
+    Creates or repairs the R-tree spatial index of a layer.
+
+    Any missing parts of the index (its table, triggers, or extension
+    registration) are created. The index is then filled from the layer's
+    geometry if anything was missing, since features changed without the
+    triggers would not be indexed, or if rebuild is True. Returns True
+    if the index was filled.
+    """
+    with transaction(immediate=True) as con:
+        if not _create_spatial_index(con, layer) and not rebuild:
+            return False
+        schema = _layer_schema(con, layer)
+        geom_col, fid_col = schema['geometry'], schema['fid']
+        rtree = f"rtree_{layer}_{geom_col}"
+        con.execute(f'DELETE FROM "{rtree}"')
+        con.execute(f"""
+            INSERT INTO "{rtree}"
+            SELECT "{fid_col}", ST_MinX("{geom_col}"), ST_MaxX("{geom_col}"),
+                ST_MinY("{geom_col}"), ST_MaxY("{geom_col}")
+            FROM "{layer}"
+            WHERE "{geom_col}" NOT NULL AND NOT ST_IsEmpty("{geom_col}")
+        """)
+    print(f"Rebuilt spatial index {rtree}.")
+    return True
 
 def find_aircraft_type_fid(code):
     """Finds an aircraft_type fid by ICAO or IATA code."""
-    layer = "aircraft_types"
-    ac_types = gpd.read_file(
-        flight_log,
-        layer=layer,
-        engine="pyogrio",
-        fid_as_index=True
-    )
-
-    for code_type in ['icao_code', 'iata_code']:
-        # Search for matching codes.
-        matching_code = ac_types[ac_types[code_type] == code]
-        if len(matching_code) == 1:
-            return matching_code.index[0]
-        if len(matching_code) > 1:
-            print(
-                colorama.Fore.YELLOW
-                + f"'{code}' matches more than one aircraft type. Setting "
-                + "value to null."
-                + colorama.Style.RESET_ALL,
-            )
-            return None
-
-    # No matches were found.
-    print(
-        colorama.Fore.YELLOW
-        + f"'{code}' did not match any aircraft type. Setting value to null."
-        + colorama.Style.RESET_ALL,
-    )
-    return None
+    return _find_fid("aircraft_types", code, "aircraft type")
 
 def find_airline_by_code(code):
     """Finds an airline fid by ICAO or IATA code."""
-    layer = "airlines"
-    airlines = gpd.read_file(
-        flight_log,
-        layer=layer,
-        engine="pyogrio",
-        fid_as_index=True
-    )
-    # Filter out defunct airlines. This is helpful in situations where
-    # current airlines use the same codes as an old airline (for
-    # example, the current PSA airlines and the defunct Comair both use
-    # the IATA code 'OH'.)
-    airlines = airlines[~airlines['is_defunct']]
-
-    for code_type in ['icao_code', 'iata_code']:
-        # Search for matching codes.
-        matching_code = airlines[airlines[code_type] == code]
-        if len(matching_code) == 1:
-            airline = matching_code.iloc[0].to_dict()
-            airline['fid'] = int(matching_code.index[0])
-            return airline
+    with transaction() as con:
+        for code_type in _CODE_COLUMNS["airlines"]:
+            # Search for matching codes.
+            matching_fids = _find_code_fids(con, "airlines", code_type, code)
+            if len(matching_fids) == 1:
+                airline = read_layer(
+                    "airlines", fids=matching_fids, with_geometry=False,
+                ).to_dict('records')[0]
+                airline['fid'] = matching_fids[0]
+                return airline
     return None
 
 def find_airline_fid(code):
     """Finds an airline fid by ICAO or IATA code."""
-    layer = "airlines"
-    airlines = gpd.read_file(
-        flight_log,
-        layer=layer,
-        engine="pyogrio",
-        fid_as_index=True
-    )
-    # Filter out defunct airlines. This is helpful in situations where
-    # current airlines use the same codes as an old airline (for
-    # example, the current PSA airlines and the defunct Comair both use
-    # the IATA code 'OH'.)
-    airlines = airlines[~airlines['is_defunct']]
-
-    for code_type in ['icao_code', 'iata_code']:
-        # Search for matching codes.
-        matching_code = airlines[airlines[code_type] == code]
-        if len(matching_code) == 1:
-            return matching_code.index[0]
-        if len(matching_code) > 1:
-            print(
-                colorama.Fore.YELLOW
-                + f"'{code}' matches more than one airline. Setting value to "
-                + "null."
-                + colorama.Style.RESET_ALL,
+    return _find_fid("airlines", code, "airline")
+
+def find_airport_fid(code):
+    """Finds an airport fid by ICAO, IATA, or FAA code."""
+    return _find_fid("airports", code, "airport")
+
+def find_imported_files(hashes, retry_failed=False):
+    """
+    Finds which files have already been imported.
+
+    Takes an iterable of SHA-256 file content hashes, and returns a dict
+    of the status recorded for each of those hashes which has been
+    recorded (see record_imported_files). If retry_failed is True, files
+    recorded with a status other than 'imported' are left out, so they
+    are imported again.
+    """
+    with transaction() as con:
+        if not _imported_files_exist(con):
+            return {}
+        columns = _layer_schema(con, _IMPORTED_FILES_TABLE)['columns']
+        status_sql = "status" if "status" in columns else "'imported'"
+        hashes = list(hashes)
+        statuses = {}
+        # Stay under SQLite's limit on the number of query parameters.
+        for i in range(0, len(hashes), 500):
+            chunk = hashes[i:i+500]
+            placeholders = ", ".join("?" * len(chunk))
+            statuses.update(con.execute(
+                f"""
+                    SELECT sha256, {status_sql} FROM {_IMPORTED_FILES_TABLE}
+                    WHERE sha256 IN ({placeholders})
+                """,
+                chunk,
+            ).fetchall())
+    if retry_failed:
+        return {h: st for h, st in statuses.items() if st == "imported"}
+    return statuses
+
+def find_layer_changes(layer, target):
+    """
+    Finds the records in a layer changed since it was last exported.
+
+    target identifies the export (such as its output path). Changes to
+    the layer are tracked from the first time this is called for it.
+    Returns a dict with the current change 'seq' (to pass to
+    record_layer_export once the export is saved), and sets of the
+    'changed' (added or edited) and 'deleted' fids. The sets are None if
+    the layer has not been exported to the target before, in which case
+    the whole layer should be exported.
+    """
+    with transaction(immediate=True) as con:
+        _track_changes(con, layer)
+        seq = con.execute(
+            "SELECT coalesce(max(seq), 0) FROM sqlite_sequence WHERE name = ?",
+            (_CHANGES_TABLE,),
+        ).fetchone()[0]
+        last_export = con.execute(
+            f"""
+                SELECT seq FROM {_EXPORTS_TABLE}
+                WHERE layer = ? AND target = ?
+            """,
+            (layer, target),
+        ).fetchone()
+        if last_export is None:
+            return {'seq': seq, 'changed': None, 'deleted': None}
+        fids = {
+            row[0] for row in con.execute(
+                f"""
+                    SELECT DISTINCT fid FROM {_CHANGES_TABLE}
+                    WHERE layer = ? AND seq > ? AND seq <= ?
+                """,
+                (layer, last_export[0], seq),
             )
-            return None
+        }
+        fid_col = _layer_schema(con, layer)['fid']
+        changed = _find_values(con, layer, fid_col, fids)
+        return {'seq': seq, 'changed': changed, 'deleted': fids - changed}
 
-    # No matches were found.
-    print(
-        colorama.Fore.YELLOW
-        + f"'{code}' did not match any airline. Setting value to null."
-        + colorama.Style.RESET_ALL,
+def find_logged_flight_ids(column, ids):
+    """
+    Finds which flights are already in the log.
+
+    column is the flights column to search ('fh_id' or 'fa_flight_id').
+    Takes an iterable of IDs, and returns the set of those IDs which are
+    already in the log. Only the indexed column is read, so this does
+    not depend on the size of the log's tracks.
+    """
+    with transaction() as con:
+        return _find_values(con, 'flights', column, ids)
+
+def geopackage_path():
+    """
+    Gets the path of the flight log GeoPackage.
+
+    The path is read from the FLIGHT_LOG_GEOPACKAGE_PATH environment
+    variable when first needed rather than at import, so that commands
+    which don't use the log can run without it.
+    """
+    path = os.getenv("FLIGHT_LOG_GEOPACKAGE_PATH")
+    if path is None:
+        raise KeyError(
+            "Environment variable FLIGHT_LOG_GEOPACKAGE_PATH is missing."
+        )
+    return path
+
+def layer_schema(layer):
+    """
+    Gets the columns and geometry type of a GeoPackage layer.
+
+    Returns a dict as described in _layer_schema.
+    """
+    with transaction() as con:
+        return _layer_schema(con, layer)
+
+def query_layer(layer, region, predicate="intersects", columns=None):
+    """
+    Finds the features of a layer which match a region.
+
+    region is a shapely geometry in the layer's CRS, or a bbox of (minx,
+    miny, maxx, maxy) longitude and latitude. A bbox with minx greater
+    than maxx crosses the antimeridian, and is split into a box on each
+    side of it. predicate is the shapely predicate features must satisfy
+    with the region (such as 'intersects' or 'within').
+
+    Candidates are found with the layer's R-tree spatial index (which is
+    created or repaired first if needed), using the bounds of each part
+    of the region, so a region split at the antimeridian doesn't match
+    every feature in between. Only the candidates are read and tested
+    with the predicate. Tracks split at the antimeridian have bounds
+    spanning all longitudes, so they are always candidates, and are
+    matched on their actual parts. Returns a GeoDataFrame indexed by
+    fid, with the listed attribute columns (all if columns is None).
+    """
+    if predicate not in _QUERY_PREDICATES:
+        raise ValueError(f"Unsupported spatial predicate '{predicate}'.")
+    if not isinstance(region, shapely.Geometry):
+        region = _bbox_region(*region)
+    ensure_spatial_index(layer)
+    with transaction() as con:
+        rtree = f"rtree_{layer}_{_layer_schema(con, layer)['geometry']}"
+        candidate_fids = set()
+        parts = shapely.get_parts(region)
+        for minx, miny, maxx, maxy in shapely.bounds(parts):
+            candidate_fids.update(row[0] for row in con.execute(
+                f"""
+                    SELECT id FROM "{rtree}"
+                    WHERE minx <= ? AND maxx >= ? AND miny <= ? AND maxy >= ?
+                """,
+                (maxx, minx, maxy, miny),
+            ))
+        candidates = read_layer(
+            layer, columns=columns, fids=sorted(candidate_fids),
+        )
+    shapely.prepare(region)
+    matches = getattr(shapely, predicate)(
+        np.asarray(candidates.geometry.values, dtype=object), region,
     )
-    return None
+    return candidates[matches]
 
-def find_airport_fid(code):
-    """Finds an airport fid by ICAO or IATA code."""
-    layer = "airports"
-    airports = gpd.read_file(
-        flight_log,
-        layer=layer,
-        engine="pyogrio",
-        fid_as_index=True
-    )
-    # Filter out defunct airports. This is helpful in situations where
-    # current airports use the same codes as an old airport (for
-    # example, the modern Denver airport and the old Denver Stapleton
-    # both use 'KDEN'/'DEN'.)
-    airports = airports[~airports['is_defunct']]
-
-    for code_type in ['icao_code', 'iata_code']:
-        # Search for matching codes.
-        matching_code = airports[airports[code_type] == code]
-        if len(matching_code) == 1:
-            return matching_code.index[0]
-        if len(matching_code) > 1:
-            print(
-                colorama.Fore.YELLOW
-                + f"'{code}' matches more than one airport. Setting value to "
-                + "null."
-                + colorama.Style.RESET_ALL,
+def read_layer(
+    layer, columns=None, where=None, params=(), fids=None, bbox=None,
+    with_geometry=True,
+):
+    """
+    Reads records from a GeoPackage layer.
+
+    Only the listed attribute columns are read (all of them if columns
+    is None), and geometry is only read and decoded if with_geometry is
+    True. Records can be filtered by an SQL where clause (with ?
+    placeholders for params), a list of fids, and a bbox of (minx,
+    miny, maxx, maxy), which selects features whose bounding boxes
+    intersect it using the layer's R-tree index.
+
+    Reads use the shared connection, so they include changes made
+    earlier in the current transaction. Returns a GeoDataFrame indexed
+    by fid, or a DataFrame if with_geometry is False or the layer has no
+    geometry.
+    """
+    with transaction() as con:
+        schema = _layer_schema(con, layer)
+        fid_col, geom_col = schema['fid'], schema['geometry']
+        if columns is None:
+            columns = schema['columns']
+        with_geometry = with_geometry and geom_col is not None
+        select = [fid_col, *columns]
+        if with_geometry:
+            select.append(geom_col)
+
+        conditions = []
+        query_params = list(params)
+        if where is not None:
+            conditions.append(f"({where})")
+        if fids is not None:
+            fids = [int(fid) for fid in fids]
+            conditions.append(
+                f'"{fid_col}" IN (SELECT value FROM json_each(?))'
             )
-            return None
+            query_params.append(json.dumps(fids))
+        if bbox is not None:
+            minx, miny, maxx, maxy = bbox
+            conditions.append(f"""
+                "{fid_col}" IN (
+                    SELECT id FROM "rtree_{layer}_{geom_col}"
+                    WHERE minx <= ? AND maxx >= ?
+                        AND miny <= ? AND maxy >= ?
+                )
+            """)
+            query_params.extend([maxx, minx, maxy, miny])
+        sql = (
+            "SELECT " + ", ".join(_column_sql(con, layer, c) for c in select)
+            + f' FROM "{layer}"'
+        )
+        if len(conditions) > 0:
+            sql += " WHERE " + " AND ".join(conditions)
+        records = pd.read_sql(
+            sql, con, params=query_params, index_col=fid_col,
+        )
 
-    # No matches were found.
-    print(
-        colorama.Fore.YELLOW
-        + f"'{code}' did not match any airport. Setting value to null."
-        + colorama.Style.RESET_ALL,
+    if not with_geometry:
+        return records
+    geoms = _gpkg_geometries(records.pop(geom_col))
+    return gpd.GeoDataFrame(
+        records,
+        geometry=gpd.GeoSeries(
+            geoms, index=records.index, crs=f"EPSG:{schema['srs_id']}",
+        ),
     )
-    return None
+
+def read_layer_batches(layer, batch_size=1000, columns=None, fids=None):
+    """
+    Reads the records of a layer in batches of raw values.
+
+    Yields lists of up to batch_size tuples, in fid order, of each
+    record's fid, its attribute columns (all of them in table order if
+    columns is None), and (for feature layers) its geometry as ISO WKB,
+    or None if missing or empty. Only one batch is held in memory at a
+    time, so whole layers can be streamed to other formats. If fids is
+    provided, only those records are read.
+    """
+    with transaction() as con:
+        schema = _layer_schema(con, layer)
+        fid_col, geom_col = schema['fid'], schema['geometry']
+        if columns is None:
+            columns = schema['columns']
+        select = [fid_col, *columns]
+        if geom_col is not None:
+            select.append(geom_col)
+        conditions = [f'"{fid_col}" > ?']
+        fid_params = []
+        if fids is not None:
+            conditions.append(
+                f'"{fid_col}" IN (SELECT value FROM json_each(?))'
+            )
+            fid_params.append(json.dumps([int(fid) for fid in fids]))
+        sql = (
+            "SELECT " + ", ".join(_column_sql(con, layer, c) for c in select)
+            + f' FROM "{layer}" WHERE ' + " AND ".join(conditions)
+            + f' ORDER BY "{fid_col}" LIMIT ?'
+        )
+
+        # Page through the layer by fid, so each batch is found with the
+        # primary key rather than by skipping earlier rows.
+        last_fid = -2**63
+        while True:
+            rows = con.execute(
+                sql, [last_fid, *fid_params, batch_size],
+            ).fetchall()
+            if len(rows) == 0:
+                return
+            if geom_col is not None:
+                rows = [(*row[:-1], _gpkg_wkb(row[-1])) for row in rows]
+            yield rows
+            last_fid = rows[-1][0]
+
+def read_stats(limit=10):
+    """
+    Reads summary statistics of the flight log.
+
+    Returns a dict of DataFrames keyed by title, with all years and the
+    top limit airports, routes, airlines, aircraft families, and tail
+    numbers. Statistics are read from the summary tables, which are
+    built first if they do not exist, so no flight geometry is read.
+    """
+    with transaction() as con:
+        stats_exist = _stats_exist(con)
+    if not stats_exist:
+        update_stats()
+    with transaction() as con:
+        return {
+            title: pd.read_sql(sql, con, params={'limit': limit})
+            for title, sql in _STATS_QUERIES.items()
+        }
+
+def record_imported_files(files):
+    """
+    Records files as imported.
+
+    Takes a list of (SHA-256 content hash, file name, status) tuples.
+    status is 'imported' for files whose contents were added to the
+    log, or else the reason they could not be (such as 'invalid' or
+    'unresolved'), so failed files are not tried again on every import.
+    """
+    with transaction(immediate=True) as con:
+        _create_imported_files_table(con)
+        con.executemany(
+            f"""
+                INSERT OR REPLACE INTO {_IMPORTED_FILES_TABLE} (
+                    sha256, file_name, status, imported_utc
+                ) VALUES (
+                    ?, ?, ?, strftime('%Y-%m-%dT%H:%M:%SZ', 'now')
+                )
+            """,
+            files,
+        )
+
+def record_layer_export(layer, target, seq):
+    """
+    Records that a layer's changes have been exported to a target.
+
+    seq is the change 'seq' returned by find_layer_changes before the
+    export. Logged changes which have been exported to every target of
+    the layer are then cleared.
+    """
+    with transaction(immediate=True) as con:
+        con.execute(
+            f"""
+                INSERT OR REPLACE INTO {_EXPORTS_TABLE} (
+                    layer, target, seq, exported_utc
+                ) VALUES (
+                    ?, ?, ?, strftime('%Y-%m-%dT%H:%M:%SZ', 'now')
+                )
+            """,
+            (layer, target, seq),
+        )
+        con.execute(
+            f"""
+                DELETE FROM {_CHANGES_TABLE}
+                WHERE layer = :layer AND seq <= (
+                    SELECT min(seq) FROM {_EXPORTS_TABLE}
+                    WHERE layer = :layer
+                )
+            """,
+            {'layer': layer},
+        )
+
+@contextlib.contextmanager
+def transaction(immediate=False):
+    """
+    Runs reads and writes to the GeoPackage in a single transaction.
+
+    Yields the shared connection. The transaction is committed when the
+    outermost block exits, or rolled back if it raises, so nested blocks
+    join the transaction of the block around them and a whole command
+    can be made atomic by running it in one block.
+
+    Set immediate to True for transactions which write, so the write
+    lock is taken when the transaction begins. A read transaction which
+    later writes fails with SQLITE_BUSY if another connection has
+    written in the meantime. Nested blocks join the outermost
+    transaction, so it must be immediate if any of them write.
+    """
+    con = _connection()
+    if con.in_transaction:
+        yield con
+        return
+    con.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
+    try:
+        yield con
+    except BaseException:
+        con.execute("ROLLBACK")
+        raise
+    con.execute("COMMIT")
 
 def update_routes():
-    """Updates the routes layer based on logged flights."""
-    con = sqlite3.connect(flight_log)
+    """Rebuilds the routes layer based on all logged flights."""
     flights_sql = """
         SELECT origin_airport_fid, destination_airport_fid,
             COUNT(*) as flight_count
@@ -218,109 +847,1078 @@ def update_routes():
         GROUP BY origin_airport_fid, destination_airport_fid
         ORDER BY origin_airport_fid, destination_airport_fid
     """
-    flights_df = pd.read_sql(flights_sql, con)
-    con.close()
+    with transaction(immediate=True) as con:
+        flights_df = pd.read_sql(flights_sql, con)
+        routes_gdf = _routes_gdf(flights_df)
+        routes_exist = con.execute(
+            "SELECT 1 FROM gpkg_contents WHERE table_name = 'routes'"
+        ).fetchone() is not None
+        if routes_exist:
+            _delete_features(con, 'routes')
+        else:
+            _create_feature_table(
+                con,
+                'routes',
+                "MULTILINESTRING",
+                [
+                    ('origin_airport_fid', "INTEGER"),
+                    ('destination_airport_fid', "INTEGER"),
+                    ('flight_count', "INTEGER"),
+                    ('distance_mi', "INTEGER"),
+                ],
+            )
+        _insert_features(con, 'routes', routes_gdf)
+    print(
+        f"Updated all routes in {geopackage_path()}."
+    )
+
+def update_simplified_tracks(rebuild=False, fids=None):
+    """
+    Updates the simplified_tracks layer for all logged flights.
+
+    Generates simplified tracks at each of SIMPLIFY_TOLERANCES for
+    flights which don't have them yet, and removes those of deleted
+    flights, creating the layer if it does not exist. If rebuild is
+    True, all simplified tracks are generated again (such as after
+    editing flight tracks). Flight tracks are read in batches, so this
+    can backfill a large log without loading every track at once.
 
-    airports = gpd.read_file(
-        flight_log,
-        layer='airports',
-        engine='pyogrio',
-        fid_as_index=True,
+    If fids is provided, only the tracks of those flights (such as
+    newly appended flights) are generated, and the rest of the layer is
+    not scanned.
+    """
+    layer = "simplified_tracks"
+    with transaction(immediate=True) as con:
+        layer_exists = con.execute(
+            "SELECT 1 FROM gpkg_contents WHERE table_name = ?", (layer,),
+        ).fetchone() is not None
+        if not layer_exists:
+            _create_feature_table(
+                con,
+                layer,
+                "MULTILINESTRING",
+                [
+                    ('flight_fid', "INTEGER"),
+                    ('tolerance_deg', "REAL"),
+                    ('vertex_count', "INTEGER"),
+                ],
+            )
+            _create_indexes(con)
+        elif rebuild:
+            _delete_features(con, layer)
+        if fids is not None:
+            missing_fids = list(fids)
+        else:
+            con.execute(f"""
+                DELETE FROM "{layer}"
+                WHERE flight_fid NOT IN (SELECT fid FROM flights)
+            """)
+            missing_fids = [
+                row[0] for row in con.execute(f"""
+                    SELECT fid FROM flights
+                    WHERE fid NOT IN (SELECT flight_fid FROM "{layer}")
+                """)
+            ]
+        for rows in read_layer_batches(
+            'flights', columns=[], fids=missing_fids,
+        ):
+            fids, wkbs = zip(*rows)
+            tracks_gdf = _simplified_tracks_gdf(fids, shapely.from_wkb(wkbs))
+            _insert_features(con, layer, tracks_gdf)
+    print(
+        f"Simplified {len(missing_fids)} flight track(s) in "
+        f"{geopackage_path()}."
     )
 
-    flights_df[['distance_mi', 'geometry']] = flights_df.apply(lambda f:
-        _great_circle_route(
-            airports.loc[f.origin_airport_fid, 'geometry'],
-            airports.loc[f.destination_airport_fid, 'geometry'],
-        ),
-        axis = 1,
+def update_stats():
+    """Rebuilds the statistics summary tables from all logged flights."""
+    with transaction(immediate=True) as con:
+        for table in _STATS_TABLES:
+            con.execute(f'DROP TABLE IF EXISTS "{table}"')
+        _create_stats_tables(con)
+        _aggregate_stats(con, where="1", existing="0", params={})
+    print(f"Updated all statistics in {geopackage_path()}.")
+
+def _add_routes(record_gdf):
+    """
+    Adds appended flights to the routes layer.
+
+    Increments flight_count in place for routes that already exist, and
+    only generates great circle geometry for new routes. If the routes
+    layer does not exist yet, it is rebuilt from all flights.
+    """
+    with transaction(immediate=True) as con:
+        routes_exist = con.execute(
+            "SELECT 1 FROM gpkg_contents WHERE table_name = 'routes'"
+        ).fetchone() is not None
+        if not routes_exist:
+            update_routes()
+            return
+
+        counts = record_gdf.groupby(
+            ['origin_airport_fid', 'destination_airport_fid'],
+        ).size()
+        new_routes = []
+        for (orig_fid, dest_fid), count in counts.items():
+            cursor = con.execute(
+                """
+                    UPDATE routes SET flight_count = flight_count + ?
+                    WHERE origin_airport_fid = ?
+                        AND destination_airport_fid = ?
+                """,
+                (int(count), int(orig_fid), int(dest_fid)),
+            )
+            if cursor.rowcount == 0:
+                new_routes.append({
+                    'origin_airport_fid': int(orig_fid),
+                    'destination_airport_fid': int(dest_fid),
+                    'flight_count': int(count),
+                })
+
+        if len(new_routes) > 0:
+            routes_gdf = _routes_gdf(pd.DataFrame(new_routes))
+            _insert_features(con, 'routes', routes_gdf)
+    print(
+        f"Updated {len(counts)} route(s) ({len(new_routes)} new) in "
+        f"{geopackage_path()}."
     )
-    flights_df['distance_mi'] = flights_df['distance_mi'].astype(int)
 
-    routes_gdf = gpd.GeoDataFrame(
-        flights_df,
-        geometry='geometry',
-        crs="EPSG:4326", # WGS-84
+def _add_stats(con, fids):
+    """
+    Adds appended flights to the statistics summary tables.
+
+    Only the appended flights are aggregated, and their counts are added
+    to the existing ones. If the tables do not exist yet, they are
+    rebuilt from all flights.
+    """
+    if not _stats_exist(con):
+        update_stats()
+        return
+    new_flight = "{alias}.fid IN (SELECT value FROM json_each(:fids))"
+    _aggregate_stats(
+        con,
+        where=new_flight.format(alias="f"),
+        existing="NOT " + new_flight.format(alias="e"),
+        params={'fids': json.dumps(fids)},
     )
+    print(f"Updated statistics for {len(fids)} flight(s).")
 
-    routes_gdf.to_file(
-        flight_log,
-        driver='GPKG',
-        engine='pyogrio',
-        layer='routes',
-        mode='w',
+def _aggregate_stats(con, where, existing, params):
+    """
+    Adds flight counts to the statistics summary tables.
+
+    where and existing are SQL conditions substituted into the queries
+    in _STATS_TABLES, and params are their parameters.
+    """
+    for table, stats in _STATS_TABLES.items():
+        keys = [name for name, _ in stats['keys']]
+        columns = ", ".join([*keys, *stats['counts']])
+        updates = ", ".join(
+            f"{count} = {count} + excluded.{count}"
+            for count in stats['counts']
+        )
+        select = stats['select'].format(where=where, existing=existing)
+        con.execute(
+            f"INSERT INTO {table} ({columns}) {select} "
+            f"ON CONFLICT ({', '.join(keys)}) DO UPDATE SET {updates}",
+            params,
+        )
+
+def _bbox_region(minx, miny, maxx, maxy):
+    """
+    Creates a region geometry from a longitude and latitude bbox.
+
+    If minx is greater than maxx, the bbox crosses the antimeridian, and
+    a MultiPolygon with a box on each side of it is returned.
+    """
+    if minx <= maxx:
+        return shapely.box(minx, miny, maxx, maxy)
+    return shapely.multipolygons([
+        shapely.box(minx, miny, 180, maxy),
+        shapely.box(-180, miny, maxx, maxy),
+    ])
+
+def _column_sql(con, layer, column):
+    """
+    Gets the SQL expression selecting a column of a layer.
+
+    Compressed fa_json payloads of flights are decompressed, so they
+    are returned just like payloads stored in the flights table.
+    """
+    if (
+        layer == 'flights' and column == 'fa_json'
+        and _fa_json_compressed(con)
+    ):
+        return f"""
+            coalesce(flights.fa_json, (
+                SELECT zlib_decompress(data) FROM {_COMPRESSED_FA_JSON_TABLE}
+                WHERE flight_fid = flights.fid
+            )) AS fa_json
+        """
+    return f'"{column}"'
+
+def _connect():
+    """
+    Opens a SQLite connection to the GeoPackage.
+
+    Registers the ST_* functions used by GeoPackage R-tree triggers, so
+    that rows in spatial tables can be updated outside of GDAL, and the
+    zlib_* functions used for compressed fa_json payloads.
+    """
+    con = sqlite3.connect(geopackage_path())
+    con.create_function(
+        "zlib_compress", 1, _zlib_compress, deterministic=True,
+    )
+    con.create_function(
+        "zlib_decompress", 1, _zlib_decompress, deterministic=True,
+    )
+    con.create_function("ST_IsEmpty", 1, _st_is_empty, deterministic=True)
+    for name, bound_index in [
+        ("ST_MinX", 0), ("ST_MinY", 1), ("ST_MaxX", 2), ("ST_MaxY", 3),
+    ]:
+        con.create_function(
+            name,
+            1,
+            lambda blob, i=bound_index: _st_bound(blob, i),
+            deterministic=True,
+        )
+    return con
+
+def _connection():
+    """
+    Gets the shared SQLite connection to the GeoPackage.
+
+    The GeoPackage is opened once per process, with the pragmas in
+    _PRAGMAS, and closed at exit so that the WAL is checkpointed into
+    the GeoPackage file. Missing lookup indexes are created when it is
+    opened. The connection is in autocommit mode; use transaction() to
+    group reads and writes.
+    """
+    global _con
+    if _con is None:
+        _con = _connect()
+        _con.isolation_level = None
+        for pragma, value in _PRAGMAS.items():
+            _con.execute(f"PRAGMA {pragma} = {value}")
+        atexit.register(_con.close)
+        with _con:
+            _create_indexes(_con)
+    return _con
+
+def _coordinate_hashes(orig_coords, dest_coords):
+    """
+    Hashes the coordinates of each route's origin and destination.
+
+    Used to detect airports which have moved since a route's geometry
+    was cached.
+    """
+    coords = np.ascontiguousarray(
+        np.column_stack([orig_coords, dest_coords]),
+        dtype="<f8",
+    )
+    return [hashlib.sha1(row.tobytes()).hexdigest() for row in coords]
+
+def _create_feature_table(con, layer, geometry_type, columns):
+    """
+    Creates an empty feature layer in WGS 84.
+
+    columns is a list of (name, SQLite type) tuples for the attribute
+    columns. The layer gets a fid column, a geom column, and an R-tree
+    spatial index.
+    """
+    column_defs = "".join(
+        f', "{name}" {sql_type}' for name, sql_type in columns
     )
+    con.execute(
+        f'CREATE TABLE "{layer}" ("fid" INTEGER PRIMARY KEY AUTOINCREMENT '
+        f'NOT NULL, "geom" {geometry_type}{column_defs})'
+    )
+    con.execute(
+        """
+            INSERT INTO gpkg_contents (
+                table_name, data_type, identifier, description,
+                last_change, srs_id
+            ) VALUES (
+                ?, 'features', ?, '',
+                strftime('%Y-%m-%dT%H:%M:%fZ', 'now'), 4326
+            )
+        """,
+        (layer, layer),
+    )
+    con.execute(
+        "INSERT INTO gpkg_geometry_columns VALUES (?, 'geom', ?, 4326, 0, 0)",
+        (layer, geometry_type),
+    )
+
+    _create_spatial_index(con, layer)
+
+    # GDAL keeps feature counts in gpkg_ogr_contents if it exists.
+    ogr_contents_exist = con.execute(
+        """
+            SELECT 1 FROM sqlite_master
+            WHERE type = 'table' AND name = 'gpkg_ogr_contents'
+        """
+    ).fetchone() is not None
+    if ogr_contents_exist:
+        con.execute(
+            "INSERT INTO gpkg_ogr_contents VALUES (?, 0)", (layer,),
+        )
+        for name, change in [('insert', "+ 1"), ('delete', "- 1")]:
+            con.execute(
+                f'CREATE TRIGGER "trigger_{name}_feature_count_{layer}" '
+                f'AFTER {name.upper()} ON "{layer}" BEGIN '
+                "UPDATE gpkg_ogr_contents SET feature_count = "
+                f"feature_count {change} WHERE lower(table_name) = "
+                f"lower('{layer}'); END"
+            )
+
+def _create_imported_files_table(con):
+    """
+    Creates the imported files table if it does not exist.
+
+    Adds the status column to tables created before it existed, with
+    their files recorded as imported.
+    """
+    con.execute(f"""
+        CREATE TABLE IF NOT EXISTS {_IMPORTED_FILES_TABLE} (
+            sha256 TEXT PRIMARY KEY,
+            file_name TEXT,
+            status TEXT NOT NULL DEFAULT 'imported',
+            imported_utc TEXT
+        )
+    """)
+    columns = _layer_schema(con, _IMPORTED_FILES_TABLE)['columns']
+    if "status" not in columns:
+        con.execute(f"""
+            ALTER TABLE {_IMPORTED_FILES_TABLE}
+            ADD COLUMN status TEXT NOT NULL DEFAULT 'imported'
+        """)
+
+def _create_indexes(con):
+    """
+    Creates indexes on the columns in _INDEXED_COLUMNS if they are
+    missing.
+
+    Returns a list of (layer, column, index name) tuples.
+    """
+    existing = {
+        row[0] for row in con.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index'"
+        )
+    }
+    indexes = []
+    for layer, columns in _INDEXED_COLUMNS.items():
+        table_columns = {
+            row[1] for row in con.execute(f'PRAGMA table_info("{layer}")')
+        }
+        for column in columns:
+            if column not in table_columns:
+                continue
+            name = f"idx_{layer}_{column}"
+            if name not in existing:
+                con.execute(f'CREATE INDEX "{name}" ON "{layer}" ("{column}")')
+                print(f"Created index {name}.")
+            indexes.append((layer, column, name))
+    return indexes
+
+def _create_spatial_index(con, layer):
+    """
+    Creates any missing parts of a layer's R-tree spatial index.
+
+    The index is a virtual R-tree table of feature bounding boxes,
+    registered as a GeoPackage extension and kept up to date by the same
+    triggers GDAL creates. Returns True if any part was missing, in
+    which case the index may be out of date and should be filled again.
+    """
+    schema = _layer_schema(con, layer)
+    geom_col, fid_col = schema['geometry'], schema['fid']
+    rtree = f"rtree_{layer}_{geom_col}"
+    existing = {
+        row[0] for row in con.execute(
+            "SELECT name FROM sqlite_master WHERE name LIKE ? || '%'",
+            (rtree,),
+        )
+    }
+    missing = False
+    if rtree not in existing:
+        con.execute(
+            f'CREATE VIRTUAL TABLE "{rtree}" '
+            "USING rtree(id, minx, maxx, miny, maxy)"
+        )
+        missing = True
+    for name, trigger in _RTREE_TRIGGERS.items():
+        if f"{rtree}_{name}" not in existing:
+            con.execute(
+                f'CREATE TRIGGER "{rtree}_{name}" '
+                + trigger.format(layer=layer, geom=geom_col, fid=fid_col)
+            )
+            missing = True
+    cursor = con.execute(
+        """
+            INSERT INTO gpkg_extensions
+            SELECT ?, ?, 'gpkg_rtree_index',
+                'http://www.geopackage.org/spec120/#extension_rtree',
+                'write-only'
+            WHERE NOT EXISTS (
+                SELECT 1 FROM gpkg_extensions
+                WHERE table_name = ? AND column_name = ?
+                    AND extension_name = 'gpkg_rtree_index'
+            )
+        """,
+        (layer, geom_col, layer, geom_col),
+    )
+    return missing or cursor.rowcount > 0
+
+def _create_stats_tables(con):
+    """Creates the statistics summary tables if they do not exist."""
+    for table, stats in _STATS_TABLES.items():
+        column_defs = ", ".join([
+            *(f"{name} {sql_type}" for name, sql_type in stats['keys']),
+            *(f"{count} INTEGER NOT NULL" for count in stats['counts']),
+        ])
+        keys = ", ".join(name for name, _ in stats['keys'])
+        con.execute(
+            f"CREATE TABLE IF NOT EXISTS {table} "
+            f"({column_defs}, PRIMARY KEY ({keys}))"
+        )
+
+def _delete_features(con, layer):
+    """
+    Deletes all features from a layer.
+
+    Also resets the layer's fids and extent, as if it had been created
+    again.
+    """
+    con.execute(f'DELETE FROM "{layer}"')
+    con.execute("DELETE FROM sqlite_sequence WHERE name = ?", (layer,))
+    con.execute(
+        """
+            UPDATE gpkg_contents SET
+                min_x = NULL, min_y = NULL, max_x = NULL, max_y = NULL
+            WHERE table_name = ?
+        """,
+        (layer,),
+    )
+
+def _fa_json_compressed(con):
+    """Checks if fa_json payloads of flights are being compressed."""
+    return con.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+        (_COMPRESSED_FA_JSON_TABLE,),
+    ).fetchone() is not None
+
+def _find_code_fids(con, layer, code_type, code):
+    """
+    Finds the fids of reference layer records with a code.
+
+    Defunct records are ignored. This is helpful in situations where
+    current airlines or airports use the same codes as an old one (for
+    example, the current PSA airlines and the defunct Comair both use
+    the IATA code 'OH'.) Returns a tuple of at most two fids, since more
+    than one means the code is ambiguous.
+    """
+    schema = _layer_schema(con, layer)
+    where = f'"{code_type}" = ?'
+    if 'is_defunct' in schema['columns']:
+        where += " AND NOT coalesce(is_defunct, 0)"
+    fid_col = schema['fid']
+    rows = con.execute(
+        f'SELECT "{fid_col}" FROM "{layer}" WHERE {where} LIMIT 2',
+        (code,),
+    ).fetchall()
+    return tuple(row[0] for row in rows)
+
+def _find_fid(layer, code, description):
+    """Finds a fid on a reference layer by code."""
+    with transaction() as con:
+        for code_type in _CODE_COLUMNS[layer]:
+            # Search for matching codes.
+            matching_fids = _find_code_fids(con, layer, code_type, code)
+            if len(matching_fids) == 1:
+                return matching_fids[0]
+            if len(matching_fids) > 1:
+                print(
+                    colorama.Fore.YELLOW
+                    + f"'{code}' matches more than one {description}. "
+                    + "Setting value to null."
+                    + colorama.Style.RESET_ALL,
+                )
+                return None
+
+    # No matches were found.
     print(
-        f"Updated all routes in {flight_log}."
-    )
-
-def _great_circle_route(point1, point2) -> pd.Series:
-    """
-    Creates a great circle line between points.
-
-    Returns a Pandas series with distance in integer miles and a
-    MultiLineString geometry.
-    """
-    if point1 == point2:
-        # Returned to same airport. Return zero great circle distance
-        # and no geometry.
-        return pd.Series([0, None])
-    geod = Geod(ellps="WGS84")
-    _, _, dist_m = geod.inv(point1.x, point1.y, point2.x, point2.y)
-    dist_mi = int(round(dist_m / METERS_PER_MILE))
-
-    # Create a great circle LineString.
-    num_points = ceil(dist_m / METERS_BETWEEN_GC_POINTS) + 1
-    midpoints = geod.npts(
-        point1.x, point1.y,
-        point2.x, point2.y,
-        num_points - 2,
-    )
-    geom = _split_at_antimeridian(
-        LineString([point1, *midpoints, point2])
-    )
-
-    return pd.Series([dist_mi, geom])
-
-def _split_at_antimeridian(linestring) -> MultiLineString:
-    """Splits a linestring at the antimeridian (180 degrees)."""
-    points = [Point(x, y) for x, y in linestring.coords]
-    if len(points) < 2:
-        return MultiLineString(linestring)
-    crossing_index = None
-    crossing_lat = None
-    crossing_lon = [None, None]
-    for i, (p1, p2) in enumerate(zip(points[:-1],points[1:])):
-        if abs(p1.x - p2.x) > 180:
-            crossing_index = i + 1
-            # Calculate crossing points at -180 and +180 longitude.
-            if p1.x > p2.x:
-                dist_to_crossing = 180 - p1.x
-                total_dist = (180 - p1.x) + (180 + p2.x)
-                crossing_lon = [180, -180]
-            else:
-                dist_to_crossing = p1.x - (-180)
-                total_dist = (p1.x - (-180)) + (180 - p2.x)
-                crossing_lon = [-180, 180]
-            if total_dist == 0:
-                crossing_lat = p1.y
-            else:
-                frac_dist = dist_to_crossing / total_dist
-                crossing_lat = p1.y + frac_dist * (p2.y - p1.y)
-            break
-    if crossing_index is None:
-        # No crossing was found. Return a single part MultiLineString.
-        return MultiLineString([linestring])
-
-    # Add crossing point to both parts of the split LineString.
-    parts = [
-        LineString([
-            *points[:crossing_index],
-            Point(crossing_lon[0], crossing_lat),
-        ]),
-        LineString([
-            Point(crossing_lon[1], crossing_lat),
-            *points[crossing_index:],
+        colorama.Fore.YELLOW
+        + f"'{code}' did not match any {description}. Setting value to "
+        + "null."
+        + colorama.Style.RESET_ALL,
+    )
+    return None
+
+def _find_values(con, table, column, values):
+    """
+    Finds which values are present in a table column.
+
+    Returns the set of the given values found in the column.
+    """
+    values = list(values)
+    found = set()
+    # Stay under SQLite's limit on the number of query parameters.
+    for i in range(0, len(values), 500):
+        chunk = values[i:i+500]
+        placeholders = ", ".join("?" * len(chunk))
+        found.update(row[0] for row in con.execute(
+            f"""
+                SELECT "{column}" FROM "{table}"
+                WHERE "{column}" IN ({placeholders})
+            """,
+            chunk,
+        ))
+    return found
+
+def _gpkg_geometries(blobs):
+    """
+    Decodes GeoPackage geometry blobs into an array of geometries.
+
+    Missing and empty geometries are decoded as None.
+    """
+    return shapely.from_wkb([_gpkg_wkb(blob) for blob in blobs])
+
+def _gpkg_geometry_blobs(geoms, srs_id):
+    """
+    Encodes geometries as GeoPackage geometry blobs.
+
+    Each blob has a little-endian header with an XY envelope (or the
+    empty flag), followed by the geometry as ISO WKB. Missing
+    geometries are encoded as None.
+    """
+    geoms = np.asarray(geoms, dtype=object)
+    wkbs = shapely.to_wkb(geoms, flavor="iso", byte_order=1)
+    bounds = shapely.bounds(geoms)
+    is_empty = shapely.is_empty(geoms)
+    blobs = []
+    for wkb, (minx, miny, maxx, maxy), empty in zip(wkbs, bounds, is_empty):
+        if wkb is None:
+            blobs.append(None)
+        elif empty:
+            blobs.append(struct.pack("<2sBBi", b"GP", 0, 0x11, srs_id) + wkb)
+        else:
+            blobs.append(struct.pack(
+                "<2sBBi4d", b"GP", 0, 0x03, srs_id, minx, maxx, miny, maxy,
+            ) + wkb)
+    return blobs
+
+def _gpkg_geometry_header(blob):
+    """
+    Parses a GeoPackage geometry blob header.
+
+    Returns a tuple of the empty flag, the envelope bounds (minx, miny,
+    maxx, maxy) or None if no envelope is stored, and the header length.
+    """
+    flags = blob[3]
+    byte_order = "<" if flags & 0x01 else ">"
+    envelope_type = (flags >> 1) & 0x07
+    is_empty = bool(flags & 0x10)
+    envelope_len = [0, 32, 48, 48, 64][envelope_type]
+    bounds = None
+    if envelope_len > 0:
+        minx, maxx, miny, maxy = struct.unpack_from(
+            f"{byte_order}4d", blob, 8,
+        )
+        bounds = (minx, miny, maxx, maxy)
+    return is_empty, bounds, 8 + envelope_len
+
+def _gpkg_wkb(blob):
+    """
+    Gets the WKB geometry from a GeoPackage geometry blob.
+
+    Missing and empty geometries return None.
+    """
+    if blob is None:
+        return None
+    is_empty, _, header_len = _gpkg_geometry_header(blob)
+    return None if is_empty else bytes(blob[header_len:])
+
+def _great_circle_routes(orig_coords, dest_coords):
+    """
+    Creates great circle lines between arrays of points.
+
+    Takes (n, 2) arrays of origin and destination longitude/latitude
+    coordinates. Returns an array of distances in integer miles and an
+    array of MultiLineString geometries, split at the antimeridian.
+    Routes which return to the same point have zero distance and no
+    geometry.
+    """
+    lon1, lat1 = orig_coords[:, 0], orig_coords[:, 1]
+    lon2, lat2 = dest_coords[:, 0], dest_coords[:, 1]
+    azimuths, _, dists_m = _GEOD.inv(lon1, lat1, lon2, lat2)
+    dists_mi = np.rint(np.asarray(dists_m) / METERS_PER_MILE).astype(int)
+    geoms = np.full(len(lon1), None, dtype=object)
+
+    # Returned to same airport. Return zero great circle distance and
+    # no geometry.
+    has_geom = (lon1 != lon2) | (lat1 != lat2)
+    dists_mi[~has_geom] = 0
+    route_index = np.flatnonzero(has_geom)
+    if len(route_index) == 0:
+        return dists_mi, geoms
+    lon1, lat1 = lon1[route_index], lat1[route_index]
+    lon2, lat2 = lon2[route_index], lat2[route_index]
+    azimuths = np.asarray(azimuths)[route_index]
+    dists_m = np.asarray(dists_m)[route_index]
+
+    # Densify all routes at once by walking each geodesic from its
+    # origin in equal steps.
+    vertex_counts = (
+        np.ceil(dists_m / METERS_BETWEEN_GC_POINTS).astype(int) + 1
+    )
+    route_ids = np.repeat(np.arange(len(route_index)), vertex_counts)
+    starts = np.cumsum(vertex_counts) - vertex_counts
+    ends = starts + vertex_counts - 1
+    vertex_steps = np.arange(len(route_ids)) - starts[route_ids]
+    lons, lats, _ = _GEOD.fwd(
+        lon1[route_ids],
+        lat1[route_ids],
+        azimuths[route_ids],
+        dists_m[route_ids] * vertex_steps / (vertex_counts[route_ids] - 1),
+    )
+    lons, lats = np.asarray(lons), np.asarray(lats)
+    lons[starts], lats[starts] = lon1, lat1
+    lons[ends], lats[ends] = lon2, lat2
+
+    # Find the first antimeridian crossing in each route. (A geodesic
+    # crosses any meridian at most once.)
+    jumps = np.abs(np.diff(lons)) > 180
+    jumps &= route_ids[1:] == route_ids[:-1]
+    crossings = np.flatnonzero(jumps)
+    _, first = np.unique(route_ids[crossings], return_index=True)
+    crossings = crossings[first]
+    crossing_routes = route_ids[crossings]
+
+    # Calculate crossing points at -180 and +180 longitude.
+    x1, y1 = lons[crossings], lats[crossings]
+    x2, y2 = lons[crossings + 1], lats[crossings + 1]
+    eastbound = x1 > x2
+    dist_to_crossing = np.where(eastbound, 180 - x1, x1 + 180)
+    total_dist = np.where(
+        eastbound, (180 - x1) + (180 + x2), (x1 + 180) + (180 - x2),
+    )
+    frac_dist = np.divide(
+        dist_to_crossing,
+        total_dist,
+        out=np.zeros_like(total_dist),
+        where=total_dist != 0,
+    )
+    crossing_lat = y1 + frac_dist * (y2 - y1)
+    crossing_lon = np.where(eastbound, 180.0, -180.0)
+
+    # Assign vertices after a crossing to a second part.
+    part_counts = np.ones(len(route_index), dtype=int)
+    part_counts[crossing_routes] = 2
+    part_starts = np.cumsum(part_counts) - part_counts
+    crossing_steps = vertex_counts.copy()
+    crossing_steps[crossing_routes] = crossings + 1 - starts[crossing_routes]
+    part_ids = (
+        part_starts[route_ids]
+        + (vertex_steps >= crossing_steps[route_ids])
+    )
+
+    # Add crossing point to both parts of the split routes.
+    coords = np.insert(
+        np.column_stack([lons, lats]),
+        np.repeat(crossings + 1, 2),
+        np.column_stack([
+            np.column_stack([crossing_lon, -crossing_lon]).ravel(),
+            np.repeat(crossing_lat, 2),
         ]),
+        axis=0,
+    )
+    crossing_parts = part_starts[crossing_routes]
+    part_ids = np.insert(
+        part_ids,
+        np.repeat(crossings + 1, 2),
+        np.column_stack([crossing_parts, crossing_parts + 1]).ravel(),
+    )
+
+    lines = shapely.linestrings(coords, indices=part_ids)
+    geoms[route_index] = shapely.multilinestrings(
+        lines,
+        indices=np.repeat(np.arange(len(route_index)), part_counts),
+    )
+    return dists_mi, geoms
+
+def _imported_files_exist(con):
+    """Checks if the imported files table exists."""
+    return con.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+        (_IMPORTED_FILES_TABLE,),
+    ).fetchone() is not None
+
+def _insert_features(con, layer, gdf):
+    """
+    Inserts the rows of a GeoDataFrame into a feature layer.
+
+    The GeoDataFrame's columns must be the geometry and a subset of the
+    layer's attribute columns. Also updates the layer's extent and last
+    change time in gpkg_contents.
+    """
+    schema = _layer_schema(con, layer)
+    geom_col = gdf.geometry.name
+    columns = [c for c in gdf.columns if c != geom_col]
+    rows = zip(
+        _gpkg_geometry_blobs(gdf.geometry.values, schema['srs_id']),
+        *(_sql_values(gdf[col]) for col in columns),
+    )
+    column_names = ", ".join(f'"{c}"' for c in [schema['geometry'], *columns])
+    placeholders = ", ".join("?" * (len(columns) + 1))
+    con.executemany(
+        f'INSERT INTO "{layer}" ({column_names}) VALUES ({placeholders})',
+        rows,
+    )
+
+    bounds = shapely.bounds(np.asarray(gdf.geometry.values, dtype=object))
+    con.execute(
+        """
+            UPDATE gpkg_contents SET
+                last_change = strftime('%Y-%m-%dT%H:%M:%fZ', 'now')
+            WHERE table_name = ?
+        """,
+        (layer,),
+    )
+    if not np.isnan(bounds).all():
+        minx, miny = np.nanmin(bounds[:, :2], axis=0)
+        maxx, maxy = np.nanmax(bounds[:, 2:], axis=0)
+        con.execute(
+            """
+                UPDATE gpkg_contents SET
+                    min_x = min(coalesce(min_x, :minx), :minx),
+                    min_y = min(coalesce(min_y, :miny), :miny),
+                    max_x = max(coalesce(max_x, :maxx), :maxx),
+                    max_y = max(coalesce(max_y, :maxy), :maxy)
+                WHERE table_name = :layer
+            """,
+            {
+                'minx': float(minx), 'miny': float(miny),
+                'maxx': float(maxx), 'maxy': float(maxy),
+                'layer': layer,
+            },
+        )
+
+def _layer_schema(con, layer):
+    """
+    Gets the columns of a GeoPackage layer.
+
+    Returns a dict with the 'fid' column name, the 'geometry' column
+    name, 'srs_id', 'geometry_type' and 'z' flag (None for attribute
+    tables), a list of the other 'columns' in table order, and a dict of
+    the declared SQL 'types' of all columns.
+    """
+    table_info = con.execute(f'PRAGMA table_info("{layer}")').fetchall()
+    if len(table_info) == 0:
+        raise ValueError(f"Layer '{layer}' not found in GeoPackage.")
+    geometry = con.execute(
+        """
+            SELECT column_name, srs_id, geometry_type_name, z
+            FROM gpkg_geometry_columns
+            WHERE table_name = ?
+        """,
+        (layer,),
+    ).fetchone()
+    geom_col, srs_id, geometry_type, z = (
+        geometry if geometry is not None else (None, None, None, None)
+    )
+    fid_col = next(row[1] for row in table_info if row[5] > 0)
+    return {
+        'fid': fid_col,
+        'geometry': geom_col,
+        'srs_id': srs_id,
+        'geometry_type': geometry_type,
+        'z': z,
+        'columns': [
+            row[1] for row in table_info
+            if row[1] not in (fid_col, geom_col)
+        ],
+        'types': {row[1]: row[2].upper() for row in table_info},
+    }
+
+def _move_fa_json(con, fids=None):
+    """
+    Moves fa_json payloads from the flights table into compressed storage.
+
+    Only payloads of the listed flight fids are moved, or all of them if
+    fids is None. A payload which replaces a compressed one (such as one
+    edited by another program) replaces it. Returns the number of
+    payloads moved.
+    """
+    where = "fa_json NOT NULL"
+    params = []
+    if fids is not None:
+        where += " AND fid IN (SELECT value FROM json_each(?))"
+        params.append(json.dumps([int(fid) for fid in fids]))
+    con.execute(
+        f"""
+            INSERT OR REPLACE INTO {_COMPRESSED_FA_JSON_TABLE}
+                (flight_fid, data)
+            SELECT fid, zlib_compress(fa_json) FROM flights WHERE {where}
+        """,
+        params,
+    )
+    return con.execute(
+        f"UPDATE flights SET fa_json = NULL WHERE {where}", params,
+    ).rowcount
+
+def _read_route_cache(con, keys):
+    """
+    Reads cached route geometry generated with the current spacing.
+
+    Takes a list of (origin fid, destination fid, coordinate hash) keys,
+    and only reads the cache entries for those keys. Returns a dict of
+    the keys found, with (distance in miles, geometry) values.
+    """
+    con.execute(f"""
+        CREATE TABLE IF NOT EXISTS {_ROUTE_CACHE_TABLE} (
+            origin_airport_fid INTEGER NOT NULL,
+            destination_airport_fid INTEGER NOT NULL,
+            coordinate_hash TEXT NOT NULL,
+            meters_between_points INTEGER NOT NULL,
+            distance_mi INTEGER NOT NULL,
+            geometry BLOB,
+            PRIMARY KEY (
+                origin_airport_fid, destination_airport_fid,
+                coordinate_hash, meters_between_points
+            )
+        )
+    """)
+    rows = con.execute(
+        f"""
+            SELECT c.origin_airport_fid, c.destination_airport_fid,
+                c.coordinate_hash, c.distance_mi, c.geometry
+            FROM json_each(?) AS k
+            JOIN {_ROUTE_CACHE_TABLE} AS c
+                ON c.origin_airport_fid = json_extract(k.value, '$[0]')
+                AND c.destination_airport_fid = json_extract(k.value, '$[1]')
+                AND c.coordinate_hash = json_extract(k.value, '$[2]')
+                AND c.meters_between_points = ?
+        """,
+        (json.dumps(keys), METERS_BETWEEN_GC_POINTS),
+    ).fetchall()
+    return {
+        (orig_fid, dest_fid, coord_hash): (
+            distance_mi,
+            None if wkb is None else shapely.from_wkb(wkb),
+        )
+        for orig_fid, dest_fid, coord_hash, distance_mi, wkb in rows
+    }
+
+def _routes_gdf(flights_df) -> gpd.GeoDataFrame:
+    """
+    Creates a routes GeoDataFrame from route flight counts.
+
+    The DataFrame must have origin_airport_fid, destination_airport_fid
+    and flight_count columns. Adds great circle distance and geometry.
+    """
+    airport_fids = set(flights_df['origin_airport_fid']) | set(
+        flights_df['destination_airport_fid']
+    )
+    airports = read_layer('airports', columns=[], fids=airport_fids).geometry
+    orig_coords = shapely.get_coordinates(
+        airports.loc[flights_df['origin_airport_fid']].values
+    )
+    dest_coords = shapely.get_coordinates(
+        airports.loc[flights_df['destination_airport_fid']].values
+    )
+    keys = list(zip(
+        flights_df['origin_airport_fid'].astype(int).tolist(),
+        flights_df['destination_airport_fid'].astype(int).tolist(),
+        _coordinate_hashes(orig_coords, dest_coords),
+    ))
+
+    # Look up cached routes, and only generate geometry for misses.
+    with transaction(immediate=True) as con:
+        cached = _read_route_cache(con, keys)
+        distances_mi = np.zeros(len(keys), dtype=int)
+        geoms = np.full(len(keys), None, dtype=object)
+        misses = []
+        for i, key in enumerate(keys):
+            if key in cached:
+                distances_mi[i], geoms[i] = cached[key]
+            else:
+                misses.append(i)
+        if len(misses) > 0:
+            distances_mi[misses], geoms[misses] = _great_circle_routes(
+                orig_coords[misses],
+                dest_coords[misses],
+            )
+            _write_route_cache(
+                con,
+                [keys[i] for i in misses],
+                distances_mi[misses],
+                geoms[misses],
+            )
+    print(
+        f"Route geometry cache: {len(keys) - len(misses)} hit(s), "
+        f"{len(misses)} miss(es)."
+    )
+
+    flights_df['distance_mi'] = distances_mi
+    flights_df['geometry'] = geoms
+
+    return gpd.GeoDataFrame(
+        flights_df,
+        geometry='geometry',
+        crs="EPSG:4326", # WGS-84
+    )
+
+def _simplified_tracks_gdf(flight_fids, tracks):
+    """
+    Creates simplified_tracks records for flight tracks.
+
+    Each track is simplified at each of SIMPLIFY_TOLERANCES with the
+    Douglas-Peucker algorithm, without Z values. Parts of a track are
+    simplified separately and keep their end points, so tracks split at
+    the antimeridian stay split there. Simplified tracks are always
+    MultiLineStrings, matching the layer's geometry type. Missing tracks
+    get records with no geometry, so they are not simplified again.
+    """
+    tracks = shapely.force_2d(np.asarray(tracks, dtype=object))
+    tiers = []
+    for tolerance in SIMPLIFY_TOLERANCES:
+        simplified = shapely.simplify(
+            tracks, tolerance, preserve_topology=False,
+        )
+        # simplify returns a LineString for a single-part track, so
+        # rebuild each track's parts into a MultiLineString.
+        parts, index = shapely.get_parts(simplified, return_index=True)
+        geoms = np.full(len(simplified), None, dtype=object)
+        if len(parts) > 0:
+            rows = np.unique(index)
+            geoms[rows] = shapely.multilinestrings(
+                parts, indices=np.searchsorted(rows, index),
+            )
+        tiers.append(gpd.GeoDataFrame(
+            {
+                'flight_fid': flight_fids,
+                'tolerance_deg': tolerance,
+                'vertex_count': shapely.get_num_coordinates(geoms),
+            },
+            geometry=gpd.GeoSeries(geoms, crs="EPSG:4326"),
+        ))
+    return pd.concat(tiers, ignore_index=True)
+
+def _sql_values(series):
+    """
+    Converts a Series to a list of values SQLite can store.
+
+    Missing values become None, and NumPy scalars become Python values.
+    """
+    return [
+        None if pd.isna(value) else (
+            value.item() if isinstance(value, np.generic) else value
+        )
+        for value in series.astype(object)
     ]
-    return MultiLineString(parts)
+
+def _st_bound(blob, bound_index):
+    """Gets a bound of a GeoPackage geometry blob (for R-tree triggers)."""
+    if blob is None:
+        return None
+    is_empty, bounds, header_len = _gpkg_geometry_header(blob)
+    if is_empty:
+        return None
+    if bounds is None:
+        bounds = shapely.from_wkb(bytes(blob[header_len:])).bounds
+    return bounds[bound_index]
+
+def _st_is_empty(blob):
+    """Checks if a GeoPackage geometry blob is empty."""
+    if blob is None:
+        return None
+    return int(_gpkg_geometry_header(blob)[0])
+
+def _stats_exist(con):
+    """Checks if all of the statistics summary tables exist."""
+    placeholders = ", ".join("?" * len(_STATS_TABLES))
+    count = con.execute(
+        f"""
+            SELECT COUNT(*) FROM sqlite_master
+            WHERE type = 'table' AND name IN ({placeholders})
+        """,
+        list(_STATS_TABLES),
+    ).fetchone()[0]
+    return count == len(_STATS_TABLES)
+
+def _track_changes(con, layer):
+    """
+    Starts logging changed fids of a layer, if not already logged.
+
+    Changes are logged by triggers, so edits made by other programs
+    (such as GIS software) are also logged.
+    """
+    con.execute(f"""
+        CREATE TABLE IF NOT EXISTS {_CHANGES_TABLE} (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            layer TEXT NOT NULL,
+            fid INTEGER NOT NULL
+        )
+    """)
+    con.execute(f"""
+        CREATE TABLE IF NOT EXISTS {_EXPORTS_TABLE} (
+            layer TEXT NOT NULL,
+            target TEXT NOT NULL,
+            seq INTEGER NOT NULL,
+            exported_utc TEXT,
+            PRIMARY KEY (layer, target)
+        )
+    """)
+    fid_col = _layer_schema(con, layer)['fid']
+    for event, rows in [
+        ('insert', ["NEW"]), ('update', ["NEW", "OLD"]), ('delete', ["OLD"]),
+    ]:
+        statements = "".join(
+            f"INSERT INTO {_CHANGES_TABLE} (layer, fid) "
+            f"VALUES ('{layer}', {row}.\"{fid_col}\"); "
+            for row in rows
+        )
+        con.execute(
+            f'CREATE TRIGGER IF NOT EXISTS "{_CHANGES_TABLE}_{layer}_{event}" '
+            f'AFTER {event.upper()} ON "{layer}" BEGIN {statements}END'
+        )
+
+def _write_route_cache(con, keys, distances_mi, geoms):
+    """
+    Saves generated route geometry to the route cache.
+
+    Replaces any stale entries for the same airport pairs.
+    """
+    con.executemany(
+        f"""
+            DELETE FROM {_ROUTE_CACHE_TABLE}
+            WHERE origin_airport_fid = ? AND destination_airport_fid = ?
+        """,
+        [(orig_fid, dest_fid) for orig_fid, dest_fid, _ in keys],
+    )
+    wkbs = shapely.to_wkb(geoms)
+    con.executemany(
+        f"""
+            INSERT INTO {_ROUTE_CACHE_TABLE} (
+                origin_airport_fid, destination_airport_fid,
+                coordinate_hash, meters_between_points, distance_mi,
+                geometry
+            ) VALUES (?, ?, ?, ?, ?, ?)
+        """,
+        [
+            (*key, METERS_BETWEEN_GC_POINTS, int(distance_mi), wkb)
+            for key, distance_mi, wkb in zip(keys, distances_mi, wkbs)
+        ],
+    )
+
+def _zlib_compress(text):
+    """Compresses a text value with zlib (for compressed payloads)."""
+    if text is None:
+        return None
+    return zlib.compress(str(text).encode("utf-8"))
+
+def _zlib_decompress(blob):
+    """Decompresses a zlib compressed text value."""
+    if blob is None:
+        return None
+    return zlib.decompress(blob).decode("utf-8")
@@ -0,0 +1,37 @@
+"""Shared HTTP session handling for web API clients."""
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Statuses which indicate a transient error worth retrying.
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+def create_session(headers=None, retries=5, backoff_factor=1, pool_size=10):
+    """
+    Creates a requests session with connection pooling and retries.
+
+    Connections are kept alive and reused across requests. GET requests
+    which fail with a connection error or a transient status are retried
+    with exponential backoff, waiting for the server's Retry-After time
+    when one is provided.
+    """
+    retry = Retry(
+        total=retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=RETRY_STATUSES,
+        allowed_methods=["GET"],
+        respect_retry_after_header=True,
+        raise_on_status=False, # Let callers use raise_for_status
+    )
+    adapter = HTTPAdapter(
+        max_retries=retry,
+        pool_connections=pool_size,
+        pool_maxsize=pool_size,
+    )
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    if headers is not None:
+        session.headers.update(headers)
+    return session
@@ -0,0 +1,104 @@
+"""On-disk cache for web API JSON responses."""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+def default_cache_path():
+    """Gets the default path of the response cache database."""
+    cache_home = os.getenv("XDG_CACHE_HOME") or os.path.join(
+        os.path.expanduser("~"), ".cache",
+    )
+    return os.path.join(cache_home, "flight_log_tools", "responses.sqlite")
+
+class ResponseCache:
+    """
+    Caches JSON responses in a SQLite database.
+
+    Responses are content-addressed by endpoint and parameters. Each
+    response is stored with an optional expiry time; responses without
+    one (such as those for completed flights) never expire.
+    """
+    def __init__(self, path=None):
+        if path is None:
+            path = default_cache_path()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.lock = threading.Lock()
+        self.con = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.con:
+            self.con.execute("""
+                CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY,
+                    endpoint TEXT NOT NULL,
+                    params TEXT NOT NULL,
+                    body TEXT NOT NULL,
+                    stored_at REAL NOT NULL,
+                    expires_at REAL
+                )
+            """)
+            self.con.execute(
+                "DELETE FROM responses WHERE expires_at < ?",
+                (time.time(),),
+            )
+
+    def get(self, endpoint, params=None):
+        """
+        Gets a cached response.
+
+        Returns None if the response is not cached or has expired.
+        """
+        with self.lock:
+            row = self.con.execute(
+                "SELECT body, expires_at FROM responses WHERE key = ?",
+                (self.key(endpoint, params),),
+            ).fetchone()
+        if row is None:
+            return None
+        body, expires_at = row
+        if expires_at is not None and expires_at < time.time():
+            return None
+        return json.loads(body)
+
+    def set(self, endpoint, params, response, ttl=None):
+        """
+        Caches a response.
+
+        ttl is the number of seconds the response remains valid, or
+        None if the response never expires. Responses with a ttl of 0
+        are not cached.
+        """
+        if ttl is not None and ttl <= 0:
+            return
+        now = time.time()
+        expires_at = None if ttl is None else now + ttl
+        with self.lock, self.con:
+            self.con.execute(
+                """
+                    INSERT OR REPLACE INTO responses (
+                        key, endpoint, params, body, stored_at, expires_at
+                    ) VALUES (?, ?, ?, ?, ?, ?)
+                """,
+                (
+                    self.key(endpoint, params),
+                    endpoint,
+                    self.__params_json(params),
+                    json.dumps(response),
+                    now,
+                    expires_at,
+                ),
+            )
+
+    @staticmethod
+    def key(endpoint, params=None):
+        """Gets the cache key for an endpoint and parameters."""
+        key_str = f"{endpoint}?{ResponseCache.__params_json(params)}"
+        return hashlib.sha256(key_str.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def __params_json(params):
+        """Serializes parameters in a stable order."""
+        return json.dumps(params or {}, sort_keys=True)
@@ -0,0 +1,140 @@
+"""Local socket server for running flight log commands."""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import socket
+import sys
+import tempfile
+import traceback
+
+def default_socket_path():
+    """Gets the default path of the server socket."""
+    runtime_dir = os.getenv("XDG_RUNTIME_DIR") or tempfile.gettempdir()
+    return os.path.join(runtime_dir, "flight_log_tools.sock")
+
+def send_command(args, socket_path=None):
+    """
+    Sends parsed command arguments to a running server.
+
+    Output from the command is written to stdout as it is received.
+    Returns the command's exit status.
+    """
+    if socket_path is None:
+        socket_path = default_socket_path()
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        try:
+            client.connect(socket_path)
+        except (FileNotFoundError, ConnectionRefusedError):
+            print(f"No flight log server is running at {socket_path}.")
+            return 1
+        with client.makefile("rwb") as stream:
+            stream.write(json.dumps(vars(args)).encode("utf-8") + b"\n")
+            stream.flush()
+            for line in stream:
+                message = json.loads(line)
+                if 'exit' in message:
+                    return message['exit']
+                sys.stdout.write(message['output'])
+                sys.stdout.flush()
+    print("The flight log server closed the connection.")
+    return 1
+
+def serve(socket_path=None):
+    """
+    Runs flight log commands sent to a Unix socket.
+
+    Libraries are loaded and the GeoPackage is opened once at startup,
+    and the AeroAPI session is kept open between commands, so each
+    command only pays for its own work. Commands are run one at a time
+    until the server is interrupted.
+    """
+    import flight_log_tools.flight_log as fl
+    import flight_log_tools.tools as flt
+
+    if socket_path is None:
+        socket_path = default_socket_path()
+    print("Opening flight log...")
+    fl.ensure_indexes()
+
+    # Remove a socket left behind by a server which did not shut down.
+    with contextlib.suppress(FileNotFoundError):
+        os.unlink(socket_path)
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as server:
+        # Create the socket with only owner permissions, so that other
+        # users cannot connect before it is listening.
+        umask = os.umask(0o077)
+        try:
+            server.bind(socket_path)
+        finally:
+            os.umask(umask)
+        os.chmod(socket_path, 0o600)
+        server.listen()
+        print(f"Serving flight log commands at {socket_path}.")
+        try:
+            while True:
+                connection, _ = server.accept()
+                with connection, connection.makefile("rwb") as stream:
+                    _handle_command(stream, flt)
+        except KeyboardInterrupt:
+            print("Stopping server.")
+        finally:
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(socket_path)
+
+class _OutputStream(io.TextIOBase):
+    """Text stream which forwards writes to a client as messages."""
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, s):
+        if len(s) > 0:
+            _send_message(self.stream, {'output': s})
+        return len(s)
+
+    def flush(self):
+        self.stream.flush()
+
+def _handle_command(stream, flt):
+    """
+    Runs one command received from a client.
+
+    Command output is sent back to the client, followed by the exit
+    status. Errors are reported to the client rather than stopping the
+    server.
+    """
+    line = stream.readline()
+    if len(line) == 0:
+        return
+    args = argparse.Namespace(**json.loads(line))
+    print(f"Running {args.command} command.")
+    output = _OutputStream(stream)
+    status = 0
+    try:
+        with (
+            contextlib.redirect_stdout(output),
+            contextlib.redirect_stderr(output),
+        ):
+            try:
+                flt.run_command(args)
+            except SystemExit as e:
+                if e.code is None or isinstance(e.code, int):
+                    status = e.code or 0
+                else:
+                    print(e.code)
+                    status = 1
+            except (BrokenPipeError, ConnectionResetError):
+                raise
+            except Exception:
+                traceback.print_exc()
+                status = 1
+        _send_message(stream, {'exit': status})
+    except (BrokenPipeError, ConnectionResetError):
+        print("Client disconnected before the command finished.")
+
+def _send_message(stream, message):
+    """Sends a JSON message line to a client."""
+    stream.write(json.dumps(message).encode("utf-8") + b"\n")
+    stream.flush()
@@ -1,25 +1,60 @@
 """Functions for CLI commands."""
 
+import glob
+import hashlib
 import os
 import sys
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
 from zoneinfo import ZoneInfo
 
-import requests
-import geopandas as gpd
+import colorama
 from dateutil import parser
-from tabulate import tabulate
 
-from flight_log_tools.aeroapi import AeroAPIWrapper
-from flight_log_tools.boarding_pass import BoardingPass
-import flight_log_tools.flight_log as fl
+from flight_log_tools.boarding_pass import BoardingPass, read_pkpass_bcbp
+
+# Modules which import geopandas, pandas, shapely, or requests are slow to
+# import, so they are imported within the commands that use them. This
+# keeps startup fast for the CLI and for boarding pass parsing workers.
+
+# Number of new .pkpass files above which they are parsed in parallel.
+_PKPASS_POOL_THRESHOLD = 32
+# Columns listed for features found by the query command.
+_QUERY_COLUMNS = {
+    'airports': ['iata_code', 'icao_code', 'name'],
+    'flights': [
+        'departure_utc', 'flight_number', 'origin_airport_fid',
+        'destination_airport_fid',
+    ],
+    'routes': [
+        'origin_airport_fid', 'destination_airport_fid', 'flight_count',
+    ],
+}
+_aeroapi = None
+
+def add_bcbp(bcbp_str):
+    """Parses a Bar-Coded Boarding Pass string and logs its flights."""
+    bp = BoardingPass(bcbp_str)
+    if not bp.valid:
+        print("The boarding pass data is not valid.")
+        quit()
+    from flight_log_tools.aeroapi import AeroAPIWrapper
+
+    records, _ = _fetch_boarding_passes([bp])
+    if len(records) > 0:
+        AeroAPIWrapper.append_records(records)
 
 def add_fa_flight_id(ident):
     """Gets flight info for an ident and saves flight(s) to log."""
-    aw = AeroAPIWrapper()
+    aw = _aeroapi_wrapper()
     aw.add_flight(ident)
 
 def add_flight_number(airline, flight_number):
     """Gets info for a flight number and logs the flight."""
+    from tabulate import tabulate
+
+    import flight_log_tools.flight_log as fl
+
     # If airline is IATA, try to look up ICAO.
     if len(airline) == 2:
         record = fl.find_airline_by_code(airline)
@@ -27,7 +62,7 @@ def add_flight_number(airline, flight_number):
             airline = record['icao_code']
     ident = f"{airline}{flight_number}"
     print(f"Looking up {ident}:")
-    aw = AeroAPIWrapper()
+    aw = _aeroapi_wrapper()
     flights = aw.get_flights_ident(ident, "designator")
     if len(flights) == 0:
         print("No matching flights found.")
@@ -64,27 +99,126 @@ def add_flight_number(airline, flight_number):
     print(selected_flight)
 
 
-def import_boarding_passes():
-    """Imports digital boarding passes."""
+def compress_fa_json(decompress=False):
+    """Moves AeroAPI fa_json payloads into compressed storage."""
+    import flight_log_tools.flight_log as fl
+
+    fl.compress_fa_json(decompress=decompress)
+
+def ensure_indexes():
+    """Creates any missing lookup indexes and lists them."""
+    from tabulate import tabulate
+
+    import flight_log_tools.flight_log as fl
+
+    indexes = fl.ensure_indexes()
+    print(tabulate(indexes, headers=["Layer", "Column", "Index"]))
+
+def export(layer, path, file_format=None, changed=False, changes_path=None):
+    """Exports a layer to a GeoParquet, FlatGeobuf, or GeoJSONSeq file."""
+    from flight_log_tools.export import export_layer
+
+    export_layer(
+        layer,
+        path,
+        file_format=file_format,
+        changed=changed,
+        changes_path=changes_path,
+    )
+
+def import_boarding_passes(retry_failed=False):
+    """
+    Imports digital boarding passes from the import folder.
+
+    Files which could not be imported before are skipped unless
+    retry_failed is True.
+    """
+    from flight_log_tools.aeroapi import AeroAPIWrapper
+    import flight_log_tools.flight_log as fl
+
+    import_path = os.getenv("FLIGHT_LOG_IMPORT_PATH")
+    if import_path is None:
+        raise KeyError(
+            "Environment variable FLIGHT_LOG_IMPORT_PATH is missing."
+        )
     print("Importing digital boarding passes...")
+    paths = sorted(glob.glob(os.path.join(import_path, "*.pkpass")))
+    if len(paths) == 0:
+        print(f"No .pkpass files found in {import_path}.")
+        return
+
+    # Skip files which have already been imported, or which failed to
+    # import.
+    hashes = {path: _file_sha256(path) for path in paths}
+    statuses = fl.find_imported_files(
+        hashes.values(), retry_failed=retry_failed,
+    )
+    new_paths = [path for path in paths if hashes[path] not in statuses]
+    failed_count = sum(status != "imported" for status in statuses.values())
+    print(
+        f"{len(paths)} .pkpass file(s) found "
+        f"({len(statuses) - failed_count} already imported, "
+        f"{failed_count} previously failed)."
+    )
+    if failed_count > 0:
+        print("Use --retry-failed to try importing failed files again.")
+    if len(new_paths) == 0:
+        return
+
+    # Parse boarding passes, in parallel for large folders.
+    if len(new_paths) > _PKPASS_POOL_THRESHOLD:
+        with ProcessPoolExecutor() as executor:
+            boarding_passes = list(
+                executor.map(_read_pkpass, new_paths, chunksize=16)
+            )
+    else:
+        boarding_passes = [_read_pkpass(path) for path in new_paths]
+    valid = []
+    files = []
+    for path, bp in zip(new_paths, boarding_passes):
+        if bp is None or not bp.valid:
+            print(
+                colorama.Fore.YELLOW
+                + f"{os.path.basename(path)} does not contain valid "
+                + "boarding pass data."
+                + colorama.Style.RESET_ALL
+            )
+            files.append((hashes[path], os.path.basename(path), "invalid"))
+            continue
+        valid.append((path, bp))
+
+    # Look up all flights first, then add flights and record their files
+    # together, so an interrupted import neither loses flights nor adds
+    # them twice. The GeoPackage is only locked while they are written,
+    # not while waiting for AeroAPI. Files with flights which are not
+    # complete yet are not recorded, so they are tried again next time.
+    records = []
+    if len(valid) > 0:
+        records, added = _fetch_boarding_passes([bp for _, bp in valid])
+        for (path, _), is_added in zip(valid, added):
+            if is_added is not None:
+                status = "imported" if is_added else "unresolved"
+                files.append((hashes[path], os.path.basename(path), status))
+    with fl.transaction(immediate=True):
+        if len(records) > 0:
+            AeroAPIWrapper.append_records(records)
+        fl.record_imported_files(files)
 
 def import_recent():
     """Finds recent flights on Flight Historian API and imports them."""
+    from flight_log_tools.http_session import create_session
+    import flight_log_tools.flight_log as fl
+
     api_key_fh = os.getenv("FLIGHT_HISTORIAN_API_KEY")
     if api_key_fh is None:
         raise KeyError(
             "Environment variable FLIGHT_HISTORIAN_API_KEY is missing."
         )
-    flight_log = os.getenv("FLIGHT_LOG_GEOPACKAGE_PATH")
-    if flight_log is None:
-        raise KeyError(
-            "Environment variable FLIGHT_LOG_GEOPACKAGE_PATH is missing."
-        )
 
     # Get recent flights.
-    headers = {"api-key": api_key_fh}
+    session = create_session(headers={"api-key": api_key_fh})
     url = "https://www.flighthistorian.com/api/recent_flights"
-    response = requests.get(url, headers=headers, timeout=10)
+    response = session.get(url, timeout=(5, 10))
     print(f"🌐 GET {response.url}")
     response.raise_for_status()
     fh_recent_flights = response.json()
@@ -93,44 +227,277 @@ def import_recent():
         quit()
     print(f"{len(fh_recent_flights)} recent flight(s) found.")
 
-    # Get list of Flight Historian IDs already in log.
-    current_flights = gpd.read_file(flight_log, layer='flights')
-    current_fh_ids = current_flights['fh_id'].unique().tolist()
+    # Find recent flights already in log, by Flight Historian ID or
+    # FlightAware ID.
+    logged_fh_ids = fl.find_logged_flight_ids(
+        'fh_id', [f['fh_id'] for f in fh_recent_flights],
+    )
+    logged_fa_flight_ids = fl.find_logged_flight_ids(
+        'fa_flight_id', [f['fa_flight_id'] for f in fh_recent_flights],
+    )
 
     # Look up recent flights with AeroAPI.
-    aw = AeroAPIWrapper()
+    idents = []
+    fields = []
     for flight in fh_recent_flights:
         print(f"Importing {flight}")
-        if flight['fh_id'] in current_fh_ids:
+        if (
+            flight['fh_id'] in logged_fh_ids
+            or flight['fa_flight_id'] in logged_fa_flight_ids
+        ):
             print("This flight is already in the log.")
             continue
-        fields = {'fh_id': flight['fh_id']}
-        aw.add_flight(flight['fa_flight_id'], fields=fields)
+        idents.append(flight['fa_flight_id'])
+        fields.append({'fh_id': flight['fh_id']})
+        logged_fh_ids.add(flight['fh_id'])
+        logged_fa_flight_ids.add(flight['fa_flight_id'])
+    if len(idents) == 0:
+        return
+    aw = _aeroapi_wrapper()
+    aw.add_flights(idents, fields=fields)
 
-def parse_bcbp(bcbp_str):
-    """Parses a Bar-Coded Boarding Pass string."""
-    bp = BoardingPass(bcbp_str)
-    if not bp.valid:
-        print("The boarding pass data is not valid.")
-        quit()
-    flight_dates = bp.flight_dates
-    for leg_index, leg in enumerate(bp.raw['legs']):
-        airline_iata = leg['operating_carrier'].strip()
-        flight_number = leg['flight_number'].strip()
-        orig_iata = leg['from_airport'].strip()
-        dest_iata = leg['to_airport'].strip()
-        print(
-            f"Leg {leg_index + 1}: {flight_dates[leg_index]} "
-            f"{airline_iata} {flight_number} "
-            f"{orig_iata} → {dest_iata}"
+def query(layer, bbox=None, wkt=None, predicate="intersects"):
+    """Lists the features of a layer which match a bbox or geometry."""
+    import shapely
+    from tabulate import tabulate
+
+    import flight_log_tools.flight_log as fl
+
+    region = bbox if wkt is None else shapely.from_wkt(wkt)
+    features = fl.query_layer(
+        layer, region, predicate=predicate, columns=_QUERY_COLUMNS[layer],
+    )
+    print(tabulate(
+        features.drop(columns=features.geometry.name),
+        headers="keys",
+    ))
+    print(f"{len(features)} feature(s) in '{layer}' match ({predicate}).")
+
+def run_command(args):
+    """Runs the command for parsed command line arguments."""
+    if args.command == "add":
+        if args.entity == "flight":
+            if args.bcbp is not None:
+                add_bcbp(args.bcbp)
+            elif args.fa_flight_id is not None:
+                add_fa_flight_id(args.fa_flight_id)
+            elif args.flight_number is not None:
+                add_flight_number(*args.flight_number)
+            elif args.pkpasses:
+                import_boarding_passes(args.retry_failed)
+            elif args.recent:
+                import_recent()
+    elif args.command == "compress-fa-json":
+        compress_fa_json(args.decompress)
+    elif args.command == "ensure-indexes":
+        ensure_indexes()
+    elif args.command == "export":
+        export(
+            args.layer, args.path, args.format, args.changed,
+            args.changes_path,
         )
+    elif args.command == "query":
+        query(args.layer, args.bbox, args.wkt, args.predicate)
+    elif args.command == "simplify-tracks":
+        simplify_tracks(args.rebuild)
+    elif args.command == "stats":
+        stats(args.top, args.rebuild)
+    elif args.command == "update-routes":
+        update_routes()
+
+def simplify_tracks(rebuild=False):
+    """Generates simplified flight tracks for any flights missing them."""
+    import flight_log_tools.flight_log as fl
+
+    fl.update_simplified_tracks(rebuild=rebuild)
+
+def stats(top=10, rebuild=False):
+    """Prints summary statistics of the flight log."""
+    from tabulate import tabulate
+
+    import flight_log_tools.flight_log as fl
+
+    if rebuild:
+        fl.update_stats()
+    for title, df in fl.read_stats(limit=top).items():
+        print(f"\n{title}\n")
+        print(tabulate(df, headers="keys", showindex=False))
 
 def update_routes():
     """Refreshes the routes table."""
+    import flight_log_tools.flight_log as fl
+
     fl.update_routes()
 
+def _aeroapi_wrapper():
+    """
+    Gets the AeroAPI wrapper for a command.
+
+    One wrapper is created per process, so its HTTP session and rate
+    limiter are kept between commands run by a server. Reference layer
+    fids are only reused within a command, since the reference layers
+    may have been edited since the last one.
+    """
+    global _aeroapi
+    if _aeroapi is None:
+        from flight_log_tools.aeroapi import AeroAPIWrapper
+
+        _aeroapi = AeroAPIWrapper()
+    else:
+        _aeroapi.fids = {}
+    return _aeroapi
+
 def _dt_str_tz(dt_str, tz):
     """Converts a datetime string into local time."""
     dt = parser.isoparse(dt_str)
     dt_tz = dt.astimezone(ZoneInfo(tz))
     return dt_tz.strftime("%a %d %b %Y %H:%M %Z")
+
+def _fetch_boarding_passes(boarding_passes):
+    """
+    Gets flight records for the flights on boarding passes.
+
+    Each leg is resolved to an AeroAPI flight, and all resolved flights
+    are fetched in one batch with their boarding pass data, without
+    saving them to the log. One AeroAPI wrapper is shared by all legs,
+    so airline, airport, and flight lookups are reused across them.
+    Returns a tuple of the list of new flight records, and a list with a
+    value for each boarding pass, which is True if all of its legs have
+    a record or were already in the log, None if any of its legs
+    matched a flight which could not be fetched (such as a flight which
+    is not complete yet), or else False.
+    """
+    import flight_log_tools.flight_log as fl
+
+    aw = _aeroapi_wrapper()
+    designator_flights = {}
+    pass_flights = []
+    pass_idents = []
+    for bp in boarding_passes:
+        leg_flights = [
+            _find_bcbp_leg_flight(aw, bp, leg_index, designator_flights)
+            for leg_index in range(len(bp.raw['legs']))
+        ]
+        pass_flights.append(leg_flights)
+        pass_idents.append([
+            None if f is None else f['fa_flight_id'] for f in leg_flights
+        ])
+
+    # Skip flights already in the log, and flights on more than one
+    # boarding pass.
+    logged_fa_flight_ids = fl.find_logged_flight_ids(
+        'fa_flight_id',
+        {ident for idents in pass_idents for ident in idents if ident},
+    )
+    done_idents = set(logged_fa_flight_ids)
+    flights = []
+    fields = []
+    for bp, leg_flights in zip(boarding_passes, pass_flights):
+        for flight in leg_flights:
+            if flight is None:
+                continue
+            if flight['fa_flight_id'] in logged_fa_flight_ids:
+                print(f"{flight['ident']} is already in the log.")
+                continue
+            flights.append(flight)
+            fields.append({'boarding_pass_data': bp.bcbp_str})
+            logged_fa_flight_ids.add(flight['fa_flight_id'])
+    records = []
+    if len(flights) == 0:
+        print("No new boarding pass flights were found.")
+    else:
+        records = aw.add_flights(
+            [f['fa_flight_id'] for f in flights],
+            fields=fields,
+            flights=flights,
+            append=False,
+        )
+        done_idents.update(record['fa_flight_id'] for record in records)
+    return records, [
+        None if any(
+            ident is not None and ident not in done_idents
+            for ident in leg_idents
+        )
+        else len(leg_idents) > 0 and None not in leg_idents
+        for leg_idents in pass_idents
+    ]
+
+def _file_sha256(path):
+    """Gets the SHA-256 hash of a file's contents."""
+    with open(path, "rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
+
+def _find_bcbp_leg_flight(aw, bp, leg_index, designator_flights):
+    """
+    Finds the AeroAPI flight for a boarding pass leg.
+
+    Matches flights by operating carrier, flight number, origin,
+    destination, and local departure date. designator_flights is a dict
+    of flights already looked up for each designator, which is updated
+    with any new lookups. Returns the flight dict, or None if there is
+    not exactly one match.
+    """
+    import flight_log_tools.flight_log as fl
+
+    leg = bp.raw['legs'][leg_index]
+    flight_date = bp.flight_dates[leg_index]
+    airline = leg['operating_carrier'].strip()
+    flight_number = leg['flight_number'].strip().lstrip("0")
+    orig_iata = leg['from_airport'].strip()
+    dest_iata = leg['to_airport'].strip()
+    leg_str = (
+        f"{flight_date} {airline} {flight_number} {orig_iata} → {dest_iata}"
+    )
+    print(f"Looking up {leg_str}:")
+    if flight_date is None:
+        print(
+            colorama.Fore.YELLOW
+            + f"{leg_str} does not have a valid date."
+            + colorama.Style.RESET_ALL
+        )
+        return None
+
+    # If airline is IATA, try to look up ICAO.
+    if len(airline) == 2:
+        record = fl.find_airline_by_code(airline)
+        if record is not None and record['icao_code'] is not None:
+            airline = record['icao_code']
+    designator = f"{airline}{flight_number}"
+    if designator not in designator_flights:
+        designator_flights[designator] = aw.get_flights_ident(
+            designator, "designator",
+        )
+    matches = {
+        f['fa_flight_id']: f for f in designator_flights[designator]
+        if f['status'] != "Diverted"
+        and f['origin']['code_iata'] == orig_iata
+        and f['destination']['code_iata'] == dest_iata
+        and _local_date(f['scheduled_out'], f['origin']['timezone'])
+            == flight_date
+    }
+    if len(matches) != 1:
+        print(
+            colorama.Fore.YELLOW
+            + f"{leg_str} matched {len(matches)} AeroAPI flights."
+            + colorama.Style.RESET_ALL
+        )
+        return None
+    return matches.popitem()[1]
+
+def _local_date(dt_str, tz):
+    """Gets the local date of a datetime string."""
+    return parser.isoparse(dt_str).astimezone(ZoneInfo(tz)).date()
+
+def _read_pkpass(path):
+    """
+    Reads and parses the boarding pass in a .pkpass file.
+
+    Returns None if the file does not contain a barcode message.
+    """
+    try:
+        bcbp_str = read_pkpass_bcbp(path)
+    except (KeyError, ValueError, zipfile.BadZipFile):
+        return None
+    if bcbp_str is None:
+        return None
+    return BoardingPass(bcbp_str)